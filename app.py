@@ -1,21 +1,38 @@
+import os
 import sys
+import asyncio
 import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
-import cv2
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import joblib
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+import time
 import uvicorn
-import io
-from PIL import Image
 import traceback
+import inference
+from prediction_cache import PredictionCache, content_key, feature_key
+from upload import read_upload, UploadRejected, MAX_UPLOAD_BYTES
+from metrics import registry, profiler, call_with_timings, observe_stages
+from model_registry import ModelRegistry, ModelNotReady, PRELOAD_ENV
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# Execution backend for the CPU-bound inference pipeline:
+#   "thread"  - thread pool; OpenCV/NumPy/sklearn release the GIL for the heavy parts
+#   "process" - process pool, every worker loads its own copy of the models
+#   "inline"  - run on the event loop (debugging only)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "thread")
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", os.cpu_count() or 1))
+
+# Prediction cache: entries (0 disables it) and time-to-live in seconds
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", 3600))
+
 # Initialize FastAPI app
 app = FastAPI(title="Plant Disease Prediction API")
 
@@ -28,80 +45,333 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Load the trained model and preprocessing objects
-try:
-    knn_model = joblib.load("knn_model.pkl")
-    label_encoder = joblib.load("label_encoder.pkl")
-    scaler = joblib.load("scaler.pkl")
-    logging.info("Model, label encoder, and scaler loaded successfully.")
-except Exception as e:
-    logging.error(f"Failed to load model or preprocessing objects: {e}")
+# Build the worker pool for the configured backend
+def create_executor():
+    if INFERENCE_BACKEND == "thread":
+        return ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+    if INFERENCE_BACKEND == "process":
+        # spawn, so workers don't inherit the event loop and its threads
+        return ProcessPoolExecutor(
+            max_workers=INFERENCE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=inference.load_models,
+        )
+    if INFERENCE_BACKEND == "inline":
+        return None
+    logging.error(f"Unknown INFERENCE_BACKEND: {INFERENCE_BACKEND}")
     sys.exit(1)
 
-# Feature extraction function
-def extract_features(image):
+executor = create_executor()
+logging.info(f"Inference backend: {INFERENCE_BACKEND} ({INFERENCE_WORKERS} workers)")
+
+# Load the trained model and preprocessing objects. Process-pool workers load their own
+# copies in the pool initializer; here we just wait for one of them to come up.
+def load_knn():
+    if INFERENCE_BACKEND == "process":
+        return executor.submit(inference.model_summary).result()
+    inference.load_models()
+    return inference.model_summary()
+
+models = ModelRegistry()
+models.register("knn", load_knn)
+
+# PRELOAD_MODELS=1 (set by gunicorn.conf.py) loads the models now, in the master, so forked
+# workers share them copy-on-write; otherwise they load in the background after startup.
+# Process-pool workers hold their own copies, so there is nothing to preload for them.
+PRELOAD_MODELS = os.environ.get(PRELOAD_ENV, "0") == "1" and INFERENCE_BACKEND != "process"
+if PRELOAD_MODELS:
     try:
-        img = cv2.resize(image, (64, 64))  # Resize to match training
-        hist = cv2.calcHist([img], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-        return cv2.normalize(hist, hist).flatten()
+        models.preload()
     except Exception as e:
-        logging.warning(f"Error extracting features: {e}")
-        return None
+        logging.error(f"Failed to load model or preprocessing objects: {e}")
+        sys.exit(1)
+
+@app.on_event("startup")
+async def load_models_in_background():
+    if not models.ready:
+        models.start()
+
+# 503 until the models are loaded, so requests during startup fail fast instead of queueing
+def require_models():
+    try:
+        models.get("knn", wait=False)
+    except ModelNotReady as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+# Dispatch a pipeline call to the worker pool so the event loop stays free.
+# Stage timings recorded by the worker come back with the result and are observed here.
+async def run_in_pool(func, *args):
+    if executor is None:
+        result, samples = call_with_timings(func, *args)
+    else:
+        loop = asyncio.get_running_loop()
+        result, samples = await loop.run_in_executor(executor, call_with_timings, func, *args)
+    observe_stages(samples)
+    return result
+
+# Results keyed by upload bytes and by quantized features; cleared when the model files change
+prediction_cache = PredictionCache(
+    max_entries=PREDICTION_CACHE_SIZE,
+    ttl=PREDICTION_CACHE_TTL,
+    watch_paths=[inference.MODEL_STORE_PATH, inference.MODEL_PATH, inference.LABEL_ENCODER_PATH, inference.SCALER_PATH,
+                 inference.CASCADE_PATH],
+)
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 # Response model
+class Neighbor(BaseModel):
+    index: Optional[int] = None  # training row; absent for a prototype
+    key: Optional[str] = None
+    prototype: Optional[bool] = None
+    distance: float
+    label: str
+
 class PredictionResponse(BaseModel):
     predicted_class: str
     confidence: float
     all_probabilities: List[float]
+    model: Optional[str] = None
+    neighbors: Optional[List[Neighbor]] = None
+
+# Upper bound on images accepted by /predict/batch in one request
+MAX_BATCH_SIZE = 64
+
+# Request body limits, checked against Content-Length before the multipart body is parsed
+MAX_BATCH_BYTES = int(os.environ.get("MAX_BATCH_BYTES", 64 * 1024 * 1024))
+MAX_REQUEST_BYTES = {
+    "/predict": MAX_UPLOAD_BYTES + 64 * 1024,  # room for the multipart framing
+    "/predict/batch": MAX_BATCH_BYTES,
+}
+
+# Endpoints whose latency and errors are recorded in /metrics
+INSTRUMENTED_PATHS = {"/predict", "/predict/batch"}
+
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    path = request.url.path
+    limit = MAX_REQUEST_BYTES.get(path)
+    length = request.headers.get("content-length")
+    if limit is not None and length is not None and length.isdigit() and int(length) > limit:
+        registry.inc("leafwish_errors_total", "type", "RequestTooLarge")
+        return JSONResponse(status_code=413, content={"detail": f"Request too large; limit is {limit} bytes"})
+    if path not in INSTRUMENTED_PATHS:
+        return await call_next(request)
+
+    start = time.perf_counter()
+    response = await call_next(request)
+    registry.observe("leafwish_request_seconds", "endpoint", path, time.perf_counter() - start)
+    registry.inc("leafwish_requests_total", "endpoint", path)
+    return response
+
+# Count a failed request by error type
+def record_error(error):
+    name = type(error).__name__
+    if isinstance(error, (HTTPException, UploadRejected)):
+        name = f"{name}_{error.status_code}"
+    registry.inc("leafwish_errors_total", "type", name)
+
+# Count which cascade stage answered a freshly computed prediction (cache hits aren't counted)
+def record_stage(result):
+    if "model" in result:
+        registry.inc("leafwish_cascade_exits_total", "stage", result["model"])
+
+# Share of the predictions reaching each cascade stage that it answered, in stage order
+def cascade_hit_rates():
+    try:
+        stages = models.get("knn", wait=False)["stages"]
+    except ModelNotReady:
+        return {}
+    exits = registry.counter_values("leafwish_cascade_exits_total", "stage")
+    reached = sum(exits.get(name, 0) for name in stages)
+    rates = {}
+    for name in stages:
+        rates[name] = exits.get(name, 0) / reached if reached else 0.0
+        reached -= exits.get(name, 0)
+    return rates
+
+# Upper bound on explainability neighbors returned per image
+MAX_NEIGHBORS = 50
 
-# Health check
+# Liveness: the process is up and serving, whether or not the models are loaded yet
 @app.get("/health")
 async def health_check():
     return {"status": "API is running"}
 
+# Readiness: 200 once every model is loaded, 503 (with per-model state) before that
+@app.get("/ready")
+async def readiness_check():
+    content = {"ready": models.ready, "models": models.status()}
+    return JSONResponse(status_code=200 if models.ready else 503, content=content)
+
+# Prediction cache hit/miss counters
+@app.get("/cache/stats")
+async def cache_stats():
+    return prediction_cache.stats()
+
+# Prometheus-style metrics: per-stage latency histograms, request latency, error counts,
+# cascade exits and per-stage hit rates
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    stats = prediction_cache.stats()
+    lines = [registry.render()]
+    for name in ("hits", "feature_hits", "misses", "evictions", "invalidations"):
+        lines.append(f"# TYPE leafwish_cache_{name}_total counter\nleafwish_cache_{name}_total {stats[name]}\n")
+    lines.append(f"# TYPE leafwish_cache_size gauge\nleafwish_cache_size {stats['size']}\n")
+    rates = cascade_hit_rates()
+    if len(rates) > 1:
+        lines.append("# HELP leafwish_cascade_hit_rate Share of the predictions reaching a cascade stage that it answered\n")
+        lines.append("# TYPE leafwish_cascade_hit_rate gauge\n")
+        lines.extend(f'leafwish_cascade_hit_rate{{stage="{name}"}} {rate}\n' for name, rate in rates.items())
+    return "".join(lines)
+
+# Sampling profiler, switched on at runtime; only available when PROFILER_ENABLED=1
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+
+def require_profiler():
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=403, detail="Profiler disabled; set PROFILER_ENABLED=1")
+
+@app.post("/debug/profiler/start")
+async def profiler_start(interval: float = Query(0.005, gt=0, le=1)):
+    require_profiler()
+    profiler.start(interval)
+    return {"running": True, "interval": interval}
+
+@app.post("/debug/profiler/stop")
+async def profiler_stop():
+    require_profiler()
+    profiler.stop()
+    return {"running": False, "samples": profiler.samples}
+
+# Collapsed stacks ("frame;frame;frame count"), ready for flamegraph tools
+@app.get("/debug/profiler", response_class=PlainTextResponse)
+async def profiler_report(top: int = Query(200, ge=1)):
+    require_profiler()
+    return profiler.collapsed(top)
+
 # Prediction endpoint
-@app.post("/predict", response_model=PredictionResponse)
-async def predict(file: UploadFile = File(...)):
+# Pass ?neighbors=k to also get the k nearest training images (index, key, distance, label)
+@app.post("/predict", response_model=PredictionResponse, response_model_exclude_none=True)
+async def predict(file: UploadFile = File(...), neighbors: int = Query(0, ge=0, le=MAX_NEIGHBORS)):
     try:
+        require_models()
+
         # Check content type
         content_type = file.content_type
         logging.info(f"Received file: {file.filename}, Content-Type: {content_type}")
         if not content_type or not content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="Invalid or missing content type; file must be an image")
 
-        # Read image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
-        image_np = np.array(image)
-        image_bgr = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
-
-        # Extract features
-        features = extract_features(image_bgr)
-        if features is None:
-            raise HTTPException(status_code=400, detail="Failed to extract features from image")
-
-        # Scale features
-        features = scaler.transform([features])
-
-        # Predict
-        pred = knn_model.predict(features)
-        pred_class = label_encoder.inverse_transform(pred)[0]
-        pred_proba = knn_model.predict_proba(features)[0]
-        confidence = float(np.max(pred_proba))
-        all_probabilities = pred_proba.tolist()
-
-        logging.info(f"Prediction: {pred_class}, Confidence: {confidence:.2f}")
-        return {
-            "predicted_class": pred_class,
-            "confidence": confidence,
-            "all_probabilities": all_probabilities,
-        }
+        # Read image in chunks, rejecting bad or oversized uploads from the header;
+        # on a cache miss decode/extract, then predict on the worker pool
+        start = time.perf_counter()
+        contents = await read_upload(file)
+        registry.observe("leafwish_stage_seconds", "stage", "upload_read", time.perf_counter() - start)
+        key = ("content", content_key(contents), neighbors)
+        result = prediction_cache.get_content(key)
+        if result is None:
+            # only decode/extract failures are the client's fault (400); anything raised
+            # while predicting is a server error and goes to the logged 500 below
+            try:
+                features = await run_in_pool(inference.image_features, contents)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            fkey = ("features", feature_key(features), neighbors)
+            result = prediction_cache.get_features(fkey)
+            if result is None:
+                result = await run_in_pool(inference.predict_one, features, neighbors)
+                record_stage(result)
+                prediction_cache.put(fkey, result)
+            prediction_cache.put(key, result)
+
+        logging.info(f"Prediction: {result['predicted_class']}, Confidence: {result['confidence']:.2f}")
+        return result
 
+    except HTTPException as e:
+        record_error(e)
+        raise
+    except UploadRejected as e:
+        record_error(e)
+        logging.warning(f"Rejected upload {file.filename}: {e.detail}")
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except Exception as e:
+        record_error(e)
         logging.error(f"Error during prediction: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Prediction failed: {str(e)}")
 
+# Batch prediction endpoint
+@app.post("/predict/batch", response_model=List[PredictionResponse], response_model_exclude_none=True)
+async def predict_batch_endpoint(files: List[UploadFile] = File(...), neighbors: int = Query(0, ge=0, le=MAX_NEIGHBORS)):
+    try:
+        return await run_batch(files, neighbors)
+    except HTTPException as e:
+        record_error(e)
+        raise
+
+async def run_batch(files, neighbors):
+    require_models()
+    if len(files) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Too many files; at most {MAX_BATCH_SIZE} images per batch")
+
+    contents = []
+    for file in files:
+        content_type = file.content_type
+        if not content_type or not content_type.startswith("image/"):
+            raise HTTPException(status_code=400, detail=f"Invalid or missing content type for {file.filename}; file must be an image")
+        try:
+            start = time.perf_counter()
+            contents.append(await read_upload(file))
+            registry.observe("leafwish_stage_seconds", "stage", "upload_read", time.perf_counter() - start)
+        except UploadRejected as e:
+            raise HTTPException(status_code=e.status_code, detail=f"{e.detail} ({file.filename})")
+
+    # Uploads already seen are answered from the cache
+    keys = [("content", content_key(c), neighbors) for c in contents]
+    results = [prediction_cache.get_content(key) for key in keys]
+    todo = [i for i, result in enumerate(results) if result is None]
+
+    # Decode + extract the rest in parallel on the pool
+    rows = await asyncio.gather(
+        *(run_in_pool(inference.image_features, contents[i]) for i in todo),
+        return_exceptions=True,
+    )
+    for i, row in zip(todo, rows):
+        if isinstance(row, ValueError):
+            raise HTTPException(status_code=400, detail=f"{row} ({files[i].filename})")
+        if isinstance(row, Exception):
+            logging.error(f"Error processing {files[i].filename}: {row}")
+            raise HTTPException(status_code=500, detail=f"Prediction failed: {str(row)}")
+
+    # Second chance on the quantized features, then stack the remaining misses into one matrix
+    fkeys = {}
+    missing = []
+    for i, row in zip(todo, rows):
+        fkeys[i] = ("features", feature_key(row), neighbors)
+        results[i] = prediction_cache.get_features(fkeys[i])
+        if results[i] is None:
+            missing.append((i, row))
+
+    if missing:
+        features = np.stack([row for _, row in missing]).astype(np.float32, copy=False)
+        try:
+            predicted = await run_in_pool(inference.predict_batch, features, neighbors)
+        except Exception as e:
+            logging.error(f"Error during batch prediction: {e}\n{traceback.format_exc()}")
+            raise HTTPException(status_code=500, detail=f"Prediction failed: {str(e)}")
+        for (i, _), result in zip(missing, predicted):
+            record_stage(result)
+            results[i] = result
+            prediction_cache.put(fkeys[i], result)
+    for i in todo:
+        prediction_cache.put(keys[i], results[i])
+
+    logging.info(f"Batch prediction: {len(results)} images")
+    return results
+
 # Run server
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
-    
\ No newline at end of file
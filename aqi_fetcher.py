@@ -1,15 +1,49 @@
-import requests
-import csv
+import os
+import random
+import asyncio
+import argparse
+import httpx
 from datetime import datetime
+from urllib.parse import quote, urlsplit
+import pandas as pd
+from aqi_store import write_observations
 
-API_TOKEN = "YOUR_REAL_WAQI_API_KEY"
+API_TOKEN = os.environ.get("WAQI_TOKEN", "YOUR_REAL_WAQI_API_KEY")
+BASE_URL = os.environ.get("WAQI_BASE_URL", "https://api.waqi.info")
 CITIES = ["New Delhi", "Shanghai", "Beijing", "Los Angeles"]
-CSV_FILE = "data/aqi_data.csv"
+COLUMNS = ["datetime","city","aqi","pm25","temp","humidity","wind","station_time"]
 
-def fetch_aqi(city):
-    url = f"https://api.waqi.info/feed/{city}/?token={API_TOKEN}"
-    res = requests.get(url).json()
-    if res["status"] != "ok":
+# Ingestion limits
+MAX_CONCURRENCY = 16        # requests in flight
+RATE_PER_HOST = 10.0        # requests per second to any one host
+TIMEOUT = 10.0              # seconds per request
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5          # seconds; doubles on every retry, plus jitter
+
+# Seconds between polls in collector (daemon) mode
+COLLECT_INTERVAL = float(os.environ.get("AQI_COLLECT_INTERVAL", 900))
+
+
+# Spaces requests to the same host at least 1/rate seconds apart
+class HostRateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = {}
+        self.lock = asyncio.Lock()
+
+    async def wait(self, host):
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            now = loop.time()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+# Turn a WAQI feed response into an observation row
+def parse_feed(city, res):
+    if res.get("status") != "ok":
         return None
     data = res["data"]
     aqi = data["aqi"]
@@ -18,28 +52,92 @@ def fetch_aqi(city):
     wind = data["iaqi"].get("w", {"v": 10})["v"]
     pm25 = data["iaqi"].get("pm25", {"v": 0})["v"]
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    return [timestamp, city, aqi, pm25, temp, humidity, wind]
+    station_time = data.get("time", {}).get("s", timestamp)  # station's local measurement time
+    return [timestamp, city, aqi, pm25, temp, humidity, wind, station_time]
+
+
+# Fetch one city, retrying timeouts, connection errors, 429 and 5xx with exponential backoff
+async def fetch_aqi(client, limiter, city, base_url=BASE_URL):
+    url = f"{base_url}/feed/{quote(city)}/"
+    host = urlsplit(url).netloc
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.wait(host)
+        try:
+            response = await client.get(url, params={"token": API_TOKEN})
+            response.raise_for_status()
+            return parse_feed(city, response.json())
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code == 429 or e.response.status_code >= 500
+            if not retryable or attempt == MAX_RETRIES:
+                print(f"Failed to fetch {city}: {e}")
+                return None
+            await asyncio.sleep(BACKOFF_BASE * 2 ** attempt * (1 + random.random()))
+        except ValueError as e:
+            print(f"Bad response for {city}: {e}")
+            return None
+
 
-def save_to_csv(row):
+# Fetch all cities over one pooled client with bounded concurrency
+async def fetch_all(cities, base_url=BASE_URL, concurrency=MAX_CONCURRENCY, rate=RATE_PER_HOST):
+    limiter = HostRateLimiter(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=TIMEOUT, limits=limits) as client:
+        async def bounded(city):
+            async with semaphore:
+                return await fetch_aqi(client, limiter, city, base_url)
+        rows = await asyncio.gather(*(bounded(city) for city in cities))
+    return [row for row in rows if row]
+
+
+# Write all rows of a run to the Parquet store in one batch; repeated station readings are dropped
+def save_rows(rows):
+    if not rows:
+        return 0
     try:
-        with open(CSV_FILE, "a", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(row)
+        df = pd.DataFrame(rows, columns=COLUMNS)
+        df["aqi"] = pd.to_numeric(df["aqi"], errors="coerce")  # WAQI reports "-" when unavailable
+        return write_observations(df)
     except Exception as e:
-        print("Error writing CSV:", e)
+        print("Error writing observations:", e)
+        return 0
+
+
+# Long-running collector: poll every `interval` seconds and write each run to the store.
+# on_saved(added) is called after runs that stored new observations.
+async def run_collector(cities=CITIES, interval=COLLECT_INTERVAL, base_url=BASE_URL, on_saved=None):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        try:
+            rows = await fetch_all(cities, base_url)
+            added = await asyncio.to_thread(save_rows, rows)
+            print(f"{datetime.now():%Y-%m-%d %H:%M:%S} collected {len(rows)}/{len(cities)} cities, {added} new observations")
+            if added and on_saved is not None:
+                on_saved(added)
+        except Exception as e:
+            print("Collector run failed:", e)
+        await asyncio.sleep(max(0.0, interval - (loop.time() - started)))
+
 
 if __name__ == "__main__":
-    # Optional: write header if CSV doesn't exist
-    try:
-        with open(CSV_FILE, "x", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(["datetime","city","aqi","pm25","temp","humidity","wind"])
-    except FileExistsError:
-        pass
-
-    # Fetch AQI for all cities
-    for city in CITIES:
-        row = fetch_aqi(city)
-        if row:
-            save_to_csv(row)
-            print(f"Saved data for {city}")
+    parser = argparse.ArgumentParser(description="Fetch AQI observations from WAQI")
+    parser.add_argument("--base-url", default=BASE_URL, help="WAQI API root (point at waqi_stub.py for testing)")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=RATE_PER_HOST, help="max requests per second per host")
+    parser.add_argument("--daemon", action="store_true", help="keep polling every --interval seconds")
+    parser.add_argument("--interval", type=float, default=COLLECT_INTERVAL)
+    parser.add_argument("cities", nargs="*", default=CITIES)
+    args = parser.parse_args()
+
+    if args.daemon:
+        try:
+            asyncio.run(run_collector(args.cities, args.interval, args.base_url))
+        except KeyboardInterrupt:
+            pass
+        raise SystemExit(0)
+
+    # Fetch AQI for all cities once
+    rows = asyncio.run(fetch_all(args.cities, args.base_url, args.concurrency, args.rate))
+    added = save_rows(rows)
+    print(f"Fetched data for {len(rows)}/{len(args.cities)} cities, {added} new observations saved")
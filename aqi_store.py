@@ -0,0 +1,118 @@
+import os
+import uuid
+from datetime import timedelta
+from urllib.parse import quote
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# AQI observations as Parquet, one file per (city, station date) partition:
+#   data/aqi/city=<city>/date=<YYYY-MM-DD>/data.parquet
+# Rows are unique per (city, station_time). Writes rewrite the (small) touched
+# partitions atomically, so readers never see a half-written file.
+STORE_DIR = "data/aqi"
+CSV_FILE = "data/aqi_data.csv"
+
+SCHEMA = pa.schema([
+    ("datetime", pa.timestamp("s")),      # when we fetched it
+    ("station_time", pa.timestamp("s")),  # station's own measurement time (dedup key)
+    ("aqi", pa.float64()),
+    ("pm25", pa.float64()),
+    ("temp", pa.float64()),
+    ("humidity", pa.float64()),
+    ("wind", pa.float64()),
+])
+PARTITION_SCHEMA = pa.schema([("city", pa.string()), ("date", pa.string())])
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor="hive")
+
+
+def _partition_dir(city, date, store_dir):
+    return os.path.join(store_dir, f"city={quote(city, safe='')}", f"date={date}")
+
+
+# Write observations (DataFrame with the SCHEMA columns plus "city"), deduplicated
+# against themselves and what is already stored. Returns the number of new rows.
+def write_observations(df, store_dir=STORE_DIR):
+    if df.empty:
+        return 0
+    df = df.copy()
+    df["datetime"] = pd.to_datetime(df["datetime"])
+    df["station_time"] = pd.to_datetime(df["station_time"]).fillna(df["datetime"])
+    df["date"] = df["station_time"].dt.strftime("%Y-%m-%d")
+
+    added = 0
+    for (city, date), part in df.groupby(["city", "date"], sort=False):
+        path = _partition_dir(city, date, store_dir)
+        target = os.path.join(path, "data.parquet")
+        part = part[[f.name for f in SCHEMA]]
+        before = 0
+        if os.path.exists(target):
+            existing = pq.read_table(target, schema=SCHEMA).to_pandas()
+            before = len(existing)
+            part = pd.concat([existing, part], ignore_index=True)
+        part = part.drop_duplicates(subset=["station_time"], keep="first").sort_values("station_time")
+        if len(part) == before:
+            continue
+        added += len(part) - before
+
+        os.makedirs(path, exist_ok=True)
+        tmp = os.path.join(path, f".{uuid.uuid4().hex}.tmp")
+        pq.write_table(pa.Table.from_pandas(part, schema=SCHEMA, preserve_index=False), tmp)
+        os.replace(tmp, target)
+    return added
+
+
+# Load observations, reading only the requested columns and the partitions that can
+# hold rows in [start, end) (by fetch time, with a day of slack for station time zones)
+def load_observations(columns=None, start=None, end=None, cities=None, store_dir=STORE_DIR):
+    if not os.path.isdir(store_dir):
+        return pd.DataFrame(columns=columns or ["city"] + [f.name for f in SCHEMA])
+    schema = pa.unify_schemas([SCHEMA, PARTITION_SCHEMA])
+    dataset = ds.dataset(store_dir, format="parquet", partitioning=PARTITIONING, schema=schema)
+
+    condition = None
+    def add(expr):
+        nonlocal condition
+        condition = expr if condition is None else condition & expr
+    if start is not None:
+        start = pd.Timestamp(start)
+        add(ds.field("date") >= (start - timedelta(days=1)).strftime("%Y-%m-%d"))
+        add(ds.field("datetime") >= pa.scalar(start.to_pydatetime(), pa.timestamp("s")))
+    if end is not None:
+        end = pd.Timestamp(end)
+        add(ds.field("date") <= (end + timedelta(days=1)).strftime("%Y-%m-%d"))
+        add(ds.field("datetime") < pa.scalar(end.to_pydatetime(), pa.timestamp("s")))
+    if cities is not None:
+        add(ds.field("city").isin(list(cities)))
+
+    columns = columns or ["datetime", "station_time", "city", "aqi", "pm25", "temp", "humidity", "wind"]
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+# Cheap change marker: (files, newest mtime) over all partitions, without reading any data
+def store_version(store_dir=STORE_DIR):
+    files, newest = 0, 0
+    for root, _, names in os.walk(store_dir):
+        for name in names:
+            if name.endswith(".parquet"):
+                files += 1
+                newest = max(newest, os.stat(os.path.join(root, name)).st_mtime_ns)
+    return files, newest
+
+
+# One-time import of the legacy append-only CSV (which has no station time; the fetch
+# time stands in for it)
+def migrate_csv(csv_file=CSV_FILE, store_dir=STORE_DIR):
+    df = pd.read_csv(csv_file, parse_dates=["datetime"])
+    df = df.dropna(subset=["datetime", "city"])
+    if "station_time" not in df.columns:
+        df["station_time"] = df["datetime"]
+    for col in ["aqi", "pm25", "temp", "humidity", "wind"]:
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+    return write_observations(df, store_dir)
+
+
+if __name__ == "__main__":
+    added = migrate_csv()
+    print(f"Migrated {added} rows from {CSV_FILE} into {STORE_DIR}")
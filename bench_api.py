@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import io
+import numpy as np
+import httpx
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+# Load up to limit images from a directory tree as (label, filename, bytes); label = folder name
+def load_corpus(image_dir, limit=None):
+    corpus = []
+    for root, _, files in os.walk(image_dir):
+        for image_name in sorted(files):
+            if not image_name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            with open(os.path.join(root, image_name), "rb") as f:
+                corpus.append((os.path.basename(root), image_name, f.read()))
+            if limit and len(corpus) >= limit:
+                return corpus
+    return corpus
+
+
+# Random leaf-sized JPEGs for when no dataset is at hand
+def synthetic_corpus(count, size=(256, 256), seed=0):
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for i in range(count):
+        base = rng.integers(0, 256, 3)
+        pixels = np.clip(base + rng.normal(0, 30, (size[1], size[0], 3)), 0, 255).astype(np.uint8)
+        buf = io.BytesIO()
+        Image.fromarray(pixels).save(buf, format="JPEG", quality=90)
+        corpus.append(("synthetic", f"synthetic_{i}.jpg", buf.getvalue()))
+    return corpus
+
+
+# Start uvicorn on app:app and wait until /ready answers: /health is up before the
+# models are loaded, and requests sent then would be measured as 503s.
+# env entries are added to the server's environment.
+def start_server(host, port, timeout=120, env=None):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--app-dir", app_dir,
+                             "--host", host, "--port", str(port)], env={**os.environ, **(env or {})})
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with code {proc.returncode}")
+        try:
+            if httpx.get(f"http://{host}:{port}/ready", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError("Server did not become ready in time")
+
+
+# Fire `requests` requests with at most `concurrency` in flight; returns per-request
+# (latency seconds, status or exception name) and the wall time
+async def run_load(base_url, corpus, requests, concurrency, batch_size=0):
+    endpoint = "/predict/batch" if batch_size else "/predict"
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results = []
+    counter = iter(range(requests))
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def send(i):
+            if batch_size:
+                items = [corpus[(i * batch_size + j) % len(corpus)] for j in range(batch_size)]
+                files = [("files", (name, data, "image/jpeg")) for _, name, data in items]
+            else:
+                _, name, data = corpus[i % len(corpus)]
+                files = {"file": (name, data, "image/jpeg")}
+            start = time.perf_counter()
+            try:
+                response = await client.post(endpoint, files=files)
+                outcome = response.status_code
+            except httpx.HTTPError as e:
+                outcome = type(e).__name__
+            results.append((time.perf_counter() - start, outcome))
+
+        async def worker():
+            for i in counter:
+                await send(i)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+    return results, wall
+
+
+# The server's prediction cache counters, or None when /cache/stats can't be read
+def cache_stats(base_url):
+    try:
+        return httpx.get(f"{base_url}/cache/stats", timeout=5).json()
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+def summarize(results, wall, images_per_request=1):
+    latencies = np.array([r[0] for r in results]) * 1000.0
+    errors = {}
+    for _, outcome in results:
+        if outcome != 200:
+            errors[str(outcome)] = errors.get(str(outcome), 0) + 1
+    return {
+        "requests": len(results),
+        "wall_seconds": wall,
+        "requests_per_second": len(results) / wall if wall else 0.0,
+        "images_per_second": len(results) * images_per_request / wall if wall else 0.0,
+        "latency_ms": {
+            "mean": float(latencies.mean()) if len(latencies) else 0.0,
+            "p50": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "p95": float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+            "p99": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+            "max": float(latencies.max()) if len(latencies) else 0.0,
+        },
+        "error_rate": sum(errors.values()) / len(results) if results else 0.0,
+        "errors": errors,
+    }
+
+
+# Load test: warm up, then measure. The corpus is cycled, so with the server's prediction
+# cache on every request after the first pass would be a cache hit: a spawned server runs
+# with the cache off unless --keep-cache, and the report carries the cache counters of
+# the measured requests either way.
+def load_test(args):
+    corpus = load_corpus(args.image_dir, args.limit) if args.image_dir else synthetic_corpus(args.synthetic)
+    if not corpus:
+        print("No images found.")
+        sys.exit(1)
+
+    host, port = args.host, args.port
+    server = None
+    if args.start_server:
+        server = start_server(host, port, env=None if args.keep_cache else {"PREDICTION_CACHE_SIZE": "0"})
+    try:
+        base_url = f"http://{host}:{port}"
+        if args.warmup:
+            asyncio.run(run_load(base_url, corpus, args.warmup, args.concurrency, args.batch_size))
+        cache_before = cache_stats(base_url)
+        results, wall = asyncio.run(run_load(base_url, corpus, args.requests, args.concurrency, args.batch_size))
+        cache_after = cache_stats(base_url)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "endpoint": "/predict/batch" if args.batch_size else "/predict",
+        "concurrency": args.concurrency,
+        "batch_size": args.batch_size,
+        "corpus_size": len(corpus),
+        "warmup": args.warmup,
+    }
+    report.update(summarize(results, wall, args.batch_size or 1))
+    report["cache"] = cache_after
+    if cache_before and cache_after:
+        report["cache"] = {**cache_after, "run": {name: cache_after[name] - cache_before[name]
+                                                  for name in ("hits", "feature_hits", "misses")}}
+    return report
+
+
+# Offline accuracy + confusion matrix over a labelled directory, through the same
+# inference pipeline the API uses (no server involved)
+def accuracy_report(args):
+    from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
+    import inference
+
+    inference.load_models()
+    corpus = load_corpus(args.image_dir, args.limit)
+    y_true, y_pred, failed = [], [], 0
+    for start in range(0, len(corpus), 64):
+        rows, labels = [], []
+        for label, _, data in corpus[start:start + 64]:
+            try:
+                rows.append(inference.image_features(data))
+                labels.append(label)
+            except ValueError:
+                failed += 1
+        if rows:
+            y_pred.extend(r["predicted_class"] for r in inference.predict_batch(np.stack(rows)))
+            y_true.extend(labels)
+
+    classes = sorted(set(y_true) | set(y_pred))
+    return {
+        "images": len(y_true),
+        "failed": failed,
+        "accuracy": accuracy_score(y_true, y_pred) if y_true else 0.0,
+        "classification_report": classification_report(y_true, y_pred, output_dict=True, zero_division=0),
+        "labels": classes,
+        "confusion_matrix": confusion_matrix(y_true, y_pred, labels=classes).tolist(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the plant disease API")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    load = sub.add_parser("load", help="concurrent load test against a running (or spawned) server")
+    load.add_argument("--image-dir", help="directory of images (default: synthetic corpus)")
+    load.add_argument("--synthetic", type=int, default=64, help="synthetic corpus size")
+    load.add_argument("--limit", type=int, default=None, help="max images to load from --image-dir")
+    load.add_argument("--requests", type=int, default=500)
+    load.add_argument("--warmup", type=int, default=20)
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--batch-size", type=int, default=0, help="use /predict/batch with this many images per request")
+    load.add_argument("--host", default="127.0.0.1")
+    load.add_argument("--port", type=int, default=8000)
+    load.add_argument("--start-server", action="store_true", help="launch uvicorn app:app for the run")
+    load.add_argument("--keep-cache", action="store_true",
+                      help="leave the spawned server's prediction cache on (repeated images become cache hits)")
+
+    acc = sub.add_parser("accuracy", help="offline accuracy and confusion report over a labelled directory")
+    acc.add_argument("image_dir", help="root folder with one subfolder per class")
+    acc.add_argument("--limit", type=int, default=None)
+
+    for p in (load, acc):
+        p.add_argument("--output", help="write the JSON report here as well")
+
+    args = parser.parse_args()
+    report = load_test(args) if args.command == "load" else accuracy_report(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+from sklearn.model_selection import train_test_split
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.preprocessing import StandardScaler
+from features import FEATURE_SETS
+from feature_cache import extract_dataset
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+# (path, label) for up to per_class images of every class folder under image_dir
+def list_items(image_dir, per_class=None):
+    items = []
+    for label in sorted(os.listdir(image_dir)):
+        label_dir = os.path.join(image_dir, label)
+        if not os.path.isdir(label_dir):
+            continue
+        paths = sorted(name for name in os.listdir(label_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+        items.extend((os.path.join(label_dir, name), label) for name in paths[:per_class])
+    return items
+
+
+# Extraction cost alone, on already decoded images, in microseconds per image
+def time_extraction(feature_set, images, repeat=3):
+    for img in images[:10]:
+        feature_set.extract(img)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for img in images:
+            feature_set.extract(img)
+        best = min(best, time.perf_counter() - start)
+    return best / len(images) * 1e6
+
+
+# KNN accuracy on a held-out split, the way train_knn.py scales and splits
+def knn_accuracy(X, y, ks, test_size=0.2):
+    X = StandardScaler().fit_transform(X)
+    stratify = y if min(np.unique(y, return_counts=True)[1]) > 1 else None
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=42, stratify=stratify)
+    return {k: float(KNeighborsClassifier(n_neighbors=k).fit(X_train, y_train).score(X_test, y_test)) for k in ks}
+
+
+# Every requested feature set: dimensionality, µs/image and accuracy at each k
+def benchmark(args):
+    items = list_items(args.image_dir, args.per_class)
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(items), min(args.timing_images, len(items)), replace=False)
+    images = [img for img in (cv2.imread(items[i][0]) for i in sample) if img is not None]
+
+    report = {"images": len(items), "classes": len({label for _, label in items}), "feature_sets": []}
+    for name in args.features:
+        feature_set = FEATURE_SETS[name]
+        X, y = extract_dataset(items, cache_dir=args.cache_dir, workers=args.workers, feature_set=name)
+        accuracy = knn_accuracy(X, y, args.k)
+        result = {
+            "name": name,
+            "version": feature_set.version,
+            "dim": feature_set.dim,
+            "us_per_image": time_extraction(feature_set, images),
+            "accuracy": accuracy,
+            "best_k": max(accuracy, key=accuracy.get),
+            "best_accuracy": max(accuracy.values()),
+        }
+        print(f"{name:18s} dim={result['dim']:4d}  {result['us_per_image']:8.1f} us/image  "
+              f"accuracy={result['best_accuracy']:.4f} (k={result['best_k']})")
+        report["feature_sets"].append(result)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare feature sets: extraction cost against KNN accuracy")
+    parser.add_argument("image_dir", help="root folder with one subfolder per class")
+    parser.add_argument("--features", nargs="+", choices=sorted(FEATURE_SETS), default=list(FEATURE_SETS))
+    parser.add_argument("--per-class", type=int, default=None, help="max images per class")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 7, 9])
+    parser.add_argument("--timing-images", type=int, default=200, help="images used to time extraction")
+    parser.add_argument("--cache-dir", default="feature_cache")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", help="write the JSON report here as well")
+    args = parser.parse_args()
+
+    report = benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
@@ -0,0 +1,165 @@
+import time
+import logging
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import HistGradientBoostingClassifier
+from metrics import stage
+
+# Cheap classifiers that can answer ahead of the neighbor search, cheapest first.
+# They are trained on the same features the index serves (after scaling/reduction).
+STAGES = ("linear", "gbm")
+
+# Accuracy-loss budgets tried by the benchmark, as fractions of the validation split
+BENCH_TOLERANCES = [0.0, 0.0025, 0.005, 0.01, 0.02, 0.05]
+
+
+def make_stage(name, random_state=42):
+    if name == "linear":
+        return LogisticRegression(max_iter=1000)
+    if name == "gbm":
+        return HistGradientBoostingClassifier(max_iter=100, max_leaf_nodes=15, early_stopping=True,
+                                              random_state=random_state)
+    raise ValueError(f"Unknown cascade stage: {name} (expected one of {list(STAGES)})")
+
+
+# Class probabilities over label indices 0..n_classes-1 (a stage may not have seen every class)
+def stage_proba(model, X, n_classes):
+    proba = model.predict_proba(X)
+    if proba.shape[1] == n_classes:
+        return proba
+    out = np.zeros((len(X), n_classes))
+    out[:, model.classes_] = proba
+    return out
+
+
+# Early-exit cascade: each stage answers the rows it is at least `threshold` confident
+# about and passes the rest on; rows no stage takes go to the neighbor search.
+class Cascade:
+    def __init__(self, stages, n_classes):
+        self.stages = stages  # [{"name", "model", "threshold"}], cheapest first
+        self.n_classes = n_classes
+
+    @property
+    def names(self):
+        return [s["name"] for s in self.stages]
+
+    # (proba, exited): probabilities of the rows a stage answered, and the position of
+    # that stage for each row (-1: no stage was confident enough)
+    def run(self, X):
+        proba = np.zeros((len(X), self.n_classes))
+        exited = np.full(len(X), -1)
+        remaining = np.arange(len(X))
+        for i, s in enumerate(self.stages):
+            if not len(remaining):
+                break
+            with stage(s["name"]):
+                p = stage_proba(s["model"], X[remaining], self.n_classes)
+            accept = p.max(axis=1) >= s["threshold"]
+            proba[remaining[accept]] = p[accept]
+            exited[remaining[accept]] = i
+            remaining = remaining[~accept]
+        return proba, exited
+
+
+# Lowest confidence threshold at which a stage may answer, given its validation
+# probabilities, the labels and whether the final model gets each row right: the stage
+# takes its most confident rows while the correct answers it loses against the final
+# model stay within `budget` rows. None when even its most confident rows cost more.
+def choose_threshold(proba, y, final_correct, budget):
+    if not len(proba):
+        return None
+    conf = proba.max(axis=1)
+    order = np.argsort(-conf, kind="stable")
+    conf = conf[order]
+    loss = np.cumsum(final_correct[order].astype(int) - (proba.argmax(axis=1)[order] == y[order]))
+    # a threshold takes every row at or above it, so only cut between distinct confidences
+    cuts = np.flatnonzero(np.append(conf[1:] < conf[:-1], True))
+    ok = cuts[loss[cuts] <= budget]
+    return float(conf[ok[-1]]) if len(ok) else None
+
+
+def fit_stages(names, X, y):
+    models = {}
+    for name in names:
+        start = time.perf_counter()
+        models[name] = make_stage(name).fit(X, y)
+        logging.info(f"Cascade stage {name} trained in {time.perf_counter() - start:.1f}s")
+    return models
+
+
+# Cascade of the named stages with thresholds set on a validation split, so the overall
+# accuracy loss against the final model alone is at most `tolerance` (split evenly
+# between the stages). Stages that can't answer anything within budget are left out, as
+# are those no row reaches once an earlier stage has taken the whole split.
+def calibrate(models, names, X_val, y_val, final_correct, n_classes, tolerance):
+    budget = tolerance * len(y_val) / max(len(names), 1)
+    remaining = np.arange(len(y_val))
+    stages = []
+    for name in names:
+        if not len(remaining):
+            break
+        proba = stage_proba(models[name], X_val[remaining], n_classes)
+        threshold = choose_threshold(proba, y_val[remaining], final_correct[remaining], budget)
+        if threshold is None:
+            continue
+        stages.append({"name": name, "model": models[name], "threshold": threshold})
+        remaining = remaining[proba.max(axis=1) < threshold]
+    return Cascade(stages, n_classes)
+
+
+# Per-query latency (seconds) of predict(X[i:i + 1]) over the first max_queries rows
+def query_seconds(predict, X, max_queries=500):
+    times = np.empty(min(len(X), max_queries))
+    for i in range(len(times)):
+        start = time.perf_counter()
+        predict(X[i:i + 1])
+        times[i] = time.perf_counter() - start
+    return times
+
+
+# Latency-vs-accuracy of the final model alone and of cascades of every prefix of
+# `names` at each tolerance, on a held-out split. Every model's single-image latency is
+# measured once per query; a cascade's latency for a query is the sum over the stages
+# it reached. `final` is the served neighbor index; its predictions are label indices.
+def benchmark(models, names, final, X_val, y_val, X_test, y_test, n_classes,
+              tolerances=None, max_queries=500):
+    final_val = final.predict(X_val) == y_val
+    final_test = final.predict(X_test)
+    X_q, y_q = X_test[:max_queries], y_test[:max_queries]
+    seconds = {"knn": query_seconds(final.predict, X_q, max_queries)}
+    for name in names:
+        seconds[name] = query_seconds(lambda X: models[name].predict_proba(X), X_q, max_queries)
+
+    results = [{
+        "stages": [], "tolerance": None, "thresholds": {},
+        "accuracy": float(np.mean(final_test == y_test)),
+        "latency_ms_per_image": float(seconds["knn"].mean() * 1000),
+        "exit_rates": {"knn": 1.0},
+    }]
+    prefixes = [names[:i] for i in range(1, len(names) + 1)]
+    for prefix in prefixes:
+        for tolerance in tolerances or BENCH_TOLERANCES:
+            cascade = calibrate(models, prefix, X_val, y_val, final_val, n_classes, tolerance)
+            proba, exited = cascade.run(X_test)
+            pred = np.where(exited >= 0, proba.argmax(axis=1), final_test)
+
+            # a query pays for every stage up to the one that answered it, or all + knn
+            q_exit = exited[:len(y_q)]
+            latency = np.zeros(len(y_q))
+            for i, name in enumerate(cascade.names):
+                latency += np.where((q_exit < 0) | (q_exit >= i), seconds[name], 0.0)
+            latency += np.where(q_exit < 0, seconds["knn"], 0.0)
+
+            rates = {name: float(np.mean(exited == i)) for i, name in enumerate(cascade.names)}
+            rates["knn"] = float(np.mean(exited < 0))
+            results.append({
+                "stages": cascade.names, "tolerance": tolerance,
+                "thresholds": {s["name"]: s["threshold"] for s in cascade.stages},
+                "accuracy": float(np.mean(pred == y_test)),
+                "latency_ms_per_image": float(latency.mean() * 1000),
+                "exit_rates": rates,
+            })
+    return {
+        "stage_latency_ms": {name: float(t.mean() * 1000) for name, t in seconds.items()},
+        "results": results,
+    }
@@ -0,0 +1,140 @@
+import logging
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.neighbors import NearestNeighbors
+from neighbor_index import ExactIndex, evaluate_index
+
+# Reference-set reduction methods:
+#   enn     - Wilson editing: drop rows their own neighbors outvote (noise, class overlap)
+#   cnn     - Hart condensation: keep only rows needed to classify the rest by 1-NN
+#   enn+cnn - editing first, so condensation doesn't keep the noisy rows
+#   kmeans  - per-class k-means centroids as prototypes, at several sizes
+METHODS = ("enn", "cnn", "enn+cnn", "kmeans")
+
+# kmeans: prototypes per class as a fraction of that class's rows
+KMEANS_LEVELS = [0.02, 0.05, 0.1, 0.2, 0.35, 0.5]
+
+# Reference row id of a k-means prototype, which stands for no single training row
+PROTOTYPE = -1
+
+ENN_NEIGHBORS = 3
+CNN_BLOCK_SIZE = 1024
+
+
+# Indices of the rows whose ENN_NEIGHBORS nearest other rows vote for their own label
+def edit(X, y, metric="euclidean", n_jobs=-1):
+    nn = NearestNeighbors(n_neighbors=ENN_NEIGHBORS + 1, metric=metric, algorithm="brute", n_jobs=n_jobs).fit(X)
+    _, ind = nn.kneighbors(X)
+    neighbors = y[ind[:, 1:]]  # first hit is the row itself
+    n_classes = int(y.max()) + 1
+    votes = np.zeros((len(X), n_classes), dtype=np.int32)
+    np.add.at(votes, (np.repeat(np.arange(len(X)), ENN_NEIGHBORS), neighbors.ravel()), 1)
+    return np.flatnonzero(votes.argmax(axis=1) == y)
+
+
+# Indices of a condensed subset that classifies every row correctly by 1-NN. Block-wise
+# variant of Hart's algorithm: each block is classified against the current subset in
+# one search and its misclassified rows are added together, with passes repeated until
+# nothing changes. Keeps somewhat more rows than the one-at-a-time original.
+def condense(X, y, metric="euclidean", random_state=42):
+    order = np.random.default_rng(random_state).permutation(len(X))
+    keep = np.zeros(len(X), dtype=bool)
+    keep[[order[np.argmax(y[order] == c)] for c in np.unique(y)]] = True  # one seed per class
+    changed = True
+    while changed:
+        changed = False
+        for start in range(0, len(order), CNN_BLOCK_SIZE):
+            block = order[start:start + CNN_BLOCK_SIZE]
+            block = block[~keep[block]]
+            if not len(block):
+                continue
+            kept = np.flatnonzero(keep)
+            index = ExactIndex(n_neighbors=1, metric=metric).fit(X[kept], y[kept])
+            wrong = block[index.predict(X[block]) != y[block]]
+            if len(wrong):
+                keep[wrong] = True
+                changed = True
+    return np.flatnonzero(keep)
+
+
+# Per-class k-means centroids: (prototypes, labels)
+def prototypes(X, y, fraction, random_state=42):
+    rows, labels = [], []
+    for c in np.unique(y):
+        Xc = X[y == c]
+        n = max(1, min(len(Xc), int(round(fraction * len(Xc)))))
+        if n == len(Xc):
+            centers = Xc
+        else:
+            kmeans = MiniBatchKMeans(n_clusters=n, random_state=random_state, n_init=3, batch_size=4096)
+            centers = kmeans.fit(Xc).cluster_centers_
+        rows.append(centers.astype(np.float32))
+        labels.append(np.full(len(centers), c, dtype=y.dtype))
+    return np.vstack(rows), np.concatenate(labels)
+
+
+# Candidate reference sets for a method: (level name, X, y, ids), where ids holds the
+# training row each reference row was kept from, or PROTOTYPE for rows that are not
+# training rows (k-means centroids)
+def reduce_reference(method, X, y, metric="euclidean", levels=None):
+    if method == "enn":
+        keep = edit(X, y, metric)
+        yield "enn", X[keep], y[keep], keep
+    elif method == "cnn":
+        keep = condense(X, y, metric)
+        yield "cnn", X[keep], y[keep], keep
+    elif method == "enn+cnn":
+        edited = edit(X, y, metric)
+        keep = edited[condense(X[edited], y[edited], metric)]
+        yield "enn+cnn", X[keep], y[keep], keep
+    elif method == "kmeans":
+        for fraction in levels or KMEANS_LEVELS:
+            centers, labels = prototypes(X, y, fraction)
+            yield f"kmeans-{fraction:g}", centers, labels, np.full(len(centers), PROTOTYPE, dtype=np.int64)
+    else:
+        raise ValueError(f"Unknown condensation method: {method} (expected one of {list(METHODS)})")
+
+
+# Size, validation accuracy and per-query latency of the full reference set (first
+# entry) and of every reduction level of the given methods. Condensed sets often work
+# best with fewer neighbors, so each level also picks its k from 1, 3 and n_neighbors.
+# index_params (metric, weights, dtype) configure the index like the one that will be served.
+# Returns the results and {level: (X, y, ids)} (see reduce_reference).
+def sweep_condensation(methods, X_train, y_train, X_val, y_val, n_neighbors, levels=None,
+                       max_queries=500, **index_params):
+    metric = index_params.get("metric", "euclidean")
+    candidates = [("full", X_train, y_train, np.arange(len(X_train)))]
+    for method in methods:
+        candidates.extend(reduce_reference(method, X_train, y_train, metric, levels))
+
+    results, reference_sets = [], {}
+    for name, X, y, ids in candidates:
+        ks = [n_neighbors] if name == "full" else sorted({1, 3, n_neighbors})
+        best = None
+        for k in [k for k in ks if k <= len(X)] or [len(X)]:
+            index = ExactIndex(n_neighbors=k, **index_params).fit(X, y)
+            accuracy = float(np.mean(index.predict(X_val) == y_val))
+            if best is None or accuracy > best[1]:
+                best = (k, accuracy, index)
+        k, accuracy, index = best
+        result = evaluate_index(index, index, X_val, y_val, max_queries=max_queries)
+        results.append({
+            "level": name,
+            "size": len(X),
+            "fraction": len(X) / len(X_train),
+            "k": k,
+            "accuracy": accuracy,
+            "latency_ms_per_query": result["latency_ms_per_query"],
+            "megabytes": index.nbytes / 2**20,
+        })
+        reference_sets[name] = (X, y, ids)
+        logging.info(f"Condensation {name}: {len(X)} rows ({len(X) / len(X_train):.1%}), k={k}, "
+                     f"accuracy={accuracy:.4f}, {result['latency_ms_per_query']:.3f} ms/query")
+    return results, reference_sets
+
+
+# Smallest reference set whose validation accuracy is within tolerance of the full set
+def choose_reference(results, tolerance):
+    baseline = results[0]["accuracy"]
+    good = [r for r in results if r["accuracy"] >= baseline - tolerance]
+    return min(good, key=lambda r: r["size"])
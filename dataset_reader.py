@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import zlib
+import logging
+import zipfile
+import argparse
+import functools
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+# Images in a directory tree: one folder per label, files keyed by their path.
+# With subdir, only the first folder of that name found under root is used
+# (the PlantVillage download has color/, grayscale/ and segmented/ side by side).
+class DirectorySource:
+    def __init__(self, root, subdir=None):
+        self.path, self.subdir = root, subdir
+        self.root = root
+        if subdir:
+            self.root = next((os.path.join(d, subdir) for d, dirs, _ in os.walk(root) if subdir in dirs), None)
+            if self.root is None:
+                raise FileNotFoundError(f"No {subdir!r} folder under {root}")
+
+    # (key, label) for every image, sorted by label then name
+    def items(self):
+        items = []
+        for d, dirs, files in os.walk(self.root):
+            dirs.sort()
+            if d == self.root:
+                continue  # loose files next to the label folders have no label
+            label = os.path.basename(d)
+            items.extend((os.path.join(d, name), label) for name in sorted(files)
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        return items
+
+    # (size, change marker) used by the feature cache to spot modified files
+    def stat(self, key):
+        st = os.stat(key)
+        return st.st_size, st.st_mtime_ns
+
+    def read(self, key):
+        with open(key, "rb") as f:
+            return f.read()
+
+
+# Images read straight out of a ZIP archive, without extracting it. Members are keyed
+# as "<archive>!<member>"; each thread opens its own handle, so reads run in parallel.
+# Only the central directory is read up front (no testzip(): a member's CRC is checked
+# when it is read).
+class ZipSource:
+    def __init__(self, path, subdir=None):
+        self.path, self.subdir = path, subdir
+        self._local = threading.local()
+        with zipfile.ZipFile(path) as archive:
+            infos = [info for info in archive.infolist()
+                     if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)]
+        if subdir:
+            infos = [info for info in infos if subdir in info.filename.split("/")[:-1]]
+            if not infos:
+                raise FileNotFoundError(f"No {subdir!r} folder in {path}")
+        self._infos = {info.filename: info for info in infos}
+
+    def _member(self, key):
+        return key[len(self.path) + 1:]
+
+    def items(self):
+        names = sorted(self._infos, key=lambda name: (name.split("/")[-2:-1], name))
+        return [(f"{self.path}!{name}", name.split("/")[-2] if "/" in name else "") for name in names]
+
+    # The member's CRC stands in for an mtime: it changes whenever the content does
+    def stat(self, key):
+        info = self._infos[self._member(key)]
+        return info.file_size, info.CRC
+
+    def read(self, key):
+        archive = getattr(self._local, "archive", None)
+        if archive is None:
+            archive = self._local.archive = zipfile.ZipFile(self.path)
+        return archive.read(self._member(key))
+
+
+# A ZIP archive or a directory tree, whichever path is
+def open_source(path, subdir=None):
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        return ZipSource(path, subdir)
+    return DirectorySource(path, subdir)
+
+
+# Decoded BGR image, or None when the bytes aren't a readable image
+def decode(data):
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+# Read and decode one image; None when it's missing, corrupt (bad CRC) or undecodable
+def load_image(source, key):
+    try:
+        return decode(source.read(key))
+    except (OSError, KeyError, zipfile.BadZipFile, cv2.error):
+        return None
+
+
+# The shard_index-th of num_shards disjoint parts of items: round-robin by position,
+# or by label (a stable hash, so every image of a class lands in the same shard)
+def shard_items(items, num_shards=1, shard_index=0, by="index"):
+    if num_shards <= 1:
+        return items
+    if by == "index":
+        return items[shard_index::num_shards]
+    if by == "label":
+        return [item for item in items if zlib.crc32(item[1].encode()) % num_shards == shard_index]
+    raise ValueError(f"Unknown shard key: {by} (expected 'index' or 'label')")
+
+
+# Stream (label, image) pairs in order while up to `workers` threads read and decode
+# ahead (zlib inflate and cv2.imdecode release the GIL). At most `prefetch` images are
+# in flight, so memory stays bounded and the first image is ready right away.
+# Unreadable images are logged and skipped.
+def iter_images(source, workers=None, num_shards=1, shard_index=0, shard_by="index", prefetch=None):
+    items = shard_items(source.items(), num_shards, shard_index, shard_by)
+    workers = workers or os.cpu_count() or 1
+    prefetch = prefetch or 4 * workers
+    load = functools.partial(load_image, source)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode") as pool:
+        pending = deque()
+        it = iter(items)
+        for key, label in it:
+            pending.append((key, label, pool.submit(load, key)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            key, label, future = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt[0], nxt[1], pool.submit(load, nxt[0])))
+            image = future.result()
+            if image is None:
+                logging.warning(f"Failed to load image: {key}")
+                continue
+            yield label, image
+
+
+# Read-through benchmark: time to the first image and sustained decode throughput
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Stream images out of a dataset ZIP or directory")
+    parser.add_argument("source", help="ZIP archive or directory with one folder per label")
+    parser.add_argument("--subdir", default=None, help="only read below folders of this name (e.g. color)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--limit", type=int, default=None, help="stop after this many images")
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--shard-index", type=int, default=0)
+    parser.add_argument("--shard-by", choices=["index", "label"], default="index")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    source = open_source(args.source, args.subdir)
+    first, count, labels = None, 0, Counter()
+    for label, image in iter_images(source, args.workers, args.num_shards, args.shard_index, args.shard_by):
+        if first is None:
+            first = time.perf_counter() - start
+        count += 1
+        labels[label] += 1
+        if args.limit and count >= args.limit:
+            break
+    elapsed = time.perf_counter() - start
+    if not count:
+        print("No images found")
+        sys.exit(1)
+    print(f"{count} images from {len(labels)} labels in {elapsed:.2f}s "
+          f"({count / elapsed:.0f} images/s, first image after {first * 1000:.0f} ms)")
+    for label, n in sorted(labels.items()):
+        print(f"  {label}: {n}")
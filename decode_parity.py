@@ -0,0 +1,64 @@
+import os
+import sys
+import argparse
+import numpy as np
+import cv2
+from inference import read_image
+from features import FEATURE_SETS, DEFAULT_FEATURE_SET, get_feature_set
+
+# Minimum cosine similarity between the upload fast path and the full-resolution
+# decode used by train_knn.py
+PARITY_TOLERANCE = 0.98
+
+
+# Features exactly as training computes them: full cv2 decode, BGR
+def reference_features(contents, feature_set):
+    img = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    return None if img is None else feature_set.extract(img)
+
+
+# Features as /predict computes them: reduced-scale JPEG decode, RGB, no channel swap
+def fast_features(contents, feature_set):
+    return feature_set.extract(read_image(contents), rgb=True)
+
+
+def cosine(a, b):
+    return float(np.dot(a, b) / max(np.linalg.norm(a) * np.linalg.norm(b), 1e-12))
+
+
+# Compare both paths for every image under image_dir
+def check_parity(image_dir, limit=None, feature_set=DEFAULT_FEATURE_SET):
+    feature_set = get_feature_set(feature_set)
+    checked, failures, worst = 0, 0, 1.0
+    for root, _, files in os.walk(image_dir):
+        for image_name in sorted(files):
+            if not image_name.lower().endswith((".jpg", ".jpeg", ".png")):
+                continue
+            image_path = os.path.join(root, image_name)
+            with open(image_path, "rb") as f:
+                contents = f.read()
+            reference = reference_features(contents, feature_set)
+            if reference is None:
+                print(f"[SKIP] {image_path}: unreadable")
+                continue
+            similarity = cosine(reference, fast_features(contents, feature_set))
+            worst = min(worst, similarity)
+            checked += 1
+            if similarity < PARITY_TOLERANCE:
+                failures += 1
+                print(f"[FAIL] {image_path}: cosine similarity {similarity:.4f}")
+            if limit and checked >= limit:
+                return checked, failures, worst
+    return checked, failures, worst
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the fast upload decode against the training features")
+    parser.add_argument("image_dir")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--features", choices=sorted(FEATURE_SETS), default=DEFAULT_FEATURE_SET)
+    args = parser.parse_args()
+
+    checked, failures, worst = check_parity(args.image_dir, args.limit, args.features)
+    print(f"Checked {checked} images, {failures} below tolerance {PARITY_TOLERANCE}, worst similarity {worst:.4f}")
+    sys.exit(1 if failures or not checked else 0)
@@ -0,0 +1,179 @@
+import os
+import glob
+import logging
+import functools
+import multiprocessing
+import numpy as np
+import cv2
+from features import get_feature_set, DEFAULT_FEATURE_SET
+from dataset_reader import open_source, load_image
+
+_source = None  # per worker: the dataset source items are read from (None: plain files)
+
+
+# Pool worker setup: OpenCV's own threading would oversubscribe the cores. A source
+# is passed as (path, subdir) and reopened here, since ZIP handles can't be pickled.
+def _init_worker(source=None):
+    global _source
+    cv2.setNumThreads(1)
+    if source is not None:
+        _source = open_source(*source)
+
+
+# Pool worker: decode + extract one file; None when the image can't be read
+def _extract_file(path, feature_set):
+    img = cv2.imread(path) if _source is None else load_image(_source, path)
+    if img is None:
+        return None
+    return get_feature_set(feature_set).extract(img)
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+# On-disk feature cache made of .npz shards. Each shard holds, for a run of images,
+# their path, size, mtime and feature vector. A file is a hit when its path, size and
+# mtime all match; newer shards take precedence over older ones for the same path.
+# Shards are written atomically as soon as they fill up, so an interrupted run resumes
+# from the last completed shard. Shards are tagged with the feature set version; shards
+# of other versions are ignored, so changing the features forces a recompute.
+# Only the index (path -> shard and row) is kept in memory; feature vectors are read
+# from their shard when gathered, so the cache can be larger than RAM.
+class FeatureCache:
+    def __init__(self, cache_dir, version):
+        self.cache_dir = cache_dir
+        self.version = version
+        os.makedirs(cache_dir, exist_ok=True)
+        self.entries = {}  # path -> (size, mtime_ns, shard, row; -1 when unreadable)
+        self.next_shard = 0
+        self._loaded = (None, None)  # the last shard read: (shard, features)
+        self._load()
+
+    def _load(self):
+        for shard in sorted(glob.glob(os.path.join(self.cache_dir, "shard_*.npz"))):
+            shard_id = int(os.path.basename(shard)[6:-4])
+            self.next_shard = max(self.next_shard, shard_id + 1)
+            try:
+                with np.load(shard) as data:
+                    if str(data["version"]) != self.version:
+                        continue
+                    for row, (path, size, mtime, ok) in enumerate(zip(
+                            data["paths"], data["sizes"], data["mtimes"], data["ok"])):
+                        self.entries[str(path)] = (int(size), int(mtime), shard, row if ok else -1)
+            except Exception as e:
+                logging.warning(f"Skipping unreadable cache shard {shard}: {e}")
+
+    # True when the cached entry for path still matches the file on disk
+    def is_fresh(self, path, size, mtime):
+        entry = self.entries.get(path)
+        return entry is not None and entry[0] == size and entry[1] == mtime
+
+    def _shard_features(self, shard):
+        if self._loaded[0] != shard:
+            with np.load(shard) as data:
+                self._loaded = (shard, data["features"])
+        return self._loaded[1]
+
+    # Feature matrix of the readable paths among `paths` (kept in order) and their
+    # positions in `paths`. Each shard involved is read once.
+    def gather(self, paths):
+        entries = [self.entries[path] for path in paths]
+        found = np.array([i for i, e in enumerate(entries) if e[3] >= 0], dtype=np.int64)
+        X = None
+        by_shard = {}
+        for j, i in enumerate(found):
+            by_shard.setdefault(entries[i][2], []).append(j)
+        for shard, js in by_shard.items():
+            features = self._shard_features(shard)
+            if X is None:
+                X = np.empty((len(found), features.shape[1]), dtype=np.float32)
+            X[js] = features[[entries[found[j]][3] for j in js]]
+        return (X if X is not None else np.empty((0, 0), dtype=np.float32)), found
+
+    def write_shard(self, rows):
+        paths = np.array([r[0] for r in rows])
+        ok = np.array([r[3] is not None for r in rows])
+        dim = next((len(r[3]) for r in rows if r[3] is not None), 0)
+        features = np.zeros((len(rows), dim), dtype=np.float32)
+        for i, r in enumerate(rows):
+            if r[3] is not None:
+                features[i] = r[3]
+
+        shard = os.path.join(self.cache_dir, f"shard_{self.next_shard:06d}.npz")
+        tmp = shard + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, version=np.array(self.version), paths=paths,
+                     sizes=np.array([r[1] for r in rows], dtype=np.int64),
+                     mtimes=np.array([r[2] for r in rows], dtype=np.int64),
+                     ok=ok, features=features)
+        os.replace(tmp, shard)
+        self.next_shard += 1
+        for row, (path, size, mtime, feats) in enumerate(rows):
+            self.entries[path] = (size, mtime, shard, row if feats is not None else -1)
+        self._loaded = (shard, features)
+
+
+# Bring the cache up to date for (path, label) items, computing only new or changed
+# files with a process pool. Returns the cache.
+# With a dataset_reader source, items are its keys and images are read through it
+# (e.g. straight out of the dataset ZIP); its stat() stands in for os.stat().
+def update_cache(items, cache_dir="feature_cache", workers=None, shard_size=2048,
+                 feature_set=DEFAULT_FEATURE_SET, source=None):
+    cache = FeatureCache(cache_dir, get_feature_set(feature_set).version)
+    stat = _file_stat if source is None else source.stat
+    todo = [(path, *stat(path)) for path, _ in items]
+    todo = [(path, size, mtime) for path, size, mtime in todo if not cache.is_fresh(path, size, mtime)]
+    logging.info(f"Feature cache: {len(items) - len(todo)} cached, {len(todo)} to extract")
+
+    if todo:
+        ctx = multiprocessing.get_context("spawn")
+        init_args = () if source is None else ((source.path, source.subdir),)
+        with ctx.Pool(workers or os.cpu_count(), initializer=_init_worker, initargs=init_args) as pool:
+            rows, done = [], 0
+            extract = functools.partial(_extract_file, feature_set=feature_set)
+            results = pool.imap(extract, [path for path, _, _ in todo], chunksize=16)
+            for (path, size, mtime), features in zip(todo, results):
+                if features is None:
+                    logging.warning(f"Failed to load image: {path}")
+                rows.append((path, size, mtime, features))
+                if len(rows) >= shard_size:
+                    cache.write_shard(rows)
+                    done += len(rows)
+                    logging.info(f"Extracted {done}/{len(todo)} images")
+                    rows = []
+            if rows:
+                cache.write_shard(rows)
+    return cache
+
+
+# (features, labels) of the readable images, chunk_size items at a time in item order,
+# straight from an up-to-date cache; only one chunk is in memory at once
+def iter_chunks(cache, items, chunk_size=8192):
+    for start in range(0, len(items), chunk_size):
+        chunk = items[start:start + chunk_size]
+        X, found = cache.gather([path for path, _ in chunk])
+        if len(found):
+            yield X, np.array([chunk[i][1] for i in found])
+
+
+# Keys (paths) of the readable images among items, in item order: one per row that
+# iter_chunks / load_dataset yield
+def readable_keys(cache, items):
+    return np.array([path for path, _ in items if cache.entries[path][3] >= 0])
+
+
+# Feature matrix and labels of the readable images, all in memory, from an up-to-date cache
+def load_dataset(cache, items):
+    chunks = list(iter_chunks(cache, items))
+    if not chunks:
+        return np.empty((0, 0), dtype=np.float32), np.array([])
+    return np.vstack([X for X, _ in chunks]), np.concatenate([y for _, y in chunks])
+
+
+# Extract features for (path, label) items (see update_cache). Returns the feature
+# matrix and labels of readable images.
+def extract_dataset(items, cache_dir="feature_cache", workers=None, shard_size=2048,
+                    feature_set=DEFAULT_FEATURE_SET, source=None):
+    return load_dataset(update_cache(items, cache_dir, workers, shard_size, feature_set, source), items)
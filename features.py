@@ -0,0 +1,167 @@
+import threading
+import numpy as np
+import cv2
+from metrics import stage
+
+# Every feature set works on the same downscaled image
+IMAGE_SIZE = (64, 64)
+
+# Color conversions per (space, input is RGB); "bgr" needs none (see _channels)
+_CONVERSIONS = {
+    ("hsv", False): cv2.COLOR_BGR2HSV, ("hsv", True): cv2.COLOR_RGB2HSV,
+    ("lab", False): cv2.COLOR_BGR2LAB, ("lab", True): cv2.COLOR_RGB2LAB,
+    ("gray", False): cv2.COLOR_BGR2GRAY, ("gray", True): cv2.COLOR_RGB2GRAY,
+}
+
+# Histogram value ranges per space (OpenCV stores 8-bit hue as 0..179)
+_RANGES = {
+    "bgr": [0, 256, 0, 256, 0, 256],
+    "hsv": [0, 180, 0, 256, 0, 256],
+    "lab": [0, 256, 0, 256, 0, 256],
+}
+
+# 8-neighbour LBP sampling offsets, in circular order
+_LBP_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
+
+# Maps each 8-bit LBP code to its uniform-pattern bin: the 58 codes with at most two
+# 0/1 transitions around the circle get their own bin, everything else shares bin 58
+def _uniform_table():
+    table = np.full(256, 58, dtype=np.intp)
+    uniform = 0
+    for code in range(256):
+        bits = [(code >> i) & 1 for i in range(8)]
+        if sum(bits[i] != bits[(i + 1) % 8] for i in range(8)) <= 2:
+            table[code] = uniform
+            uniform += 1
+    return table
+
+
+_LBP_TABLE = _uniform_table()
+LBP_BINS = 59
+
+
+# Histogram channel order: the legacy "bgr" set reads an RGB image as B, G, R, which
+# gives the same vector as a BGR image without converting it
+def _channels(space, rgb):
+    return [2, 1, 0] if space == "bgr" and rgb else [0, 1, 2]
+
+
+# L2-normalized joint color histogram
+def _hist(views, space, bins):
+    hist = cv2.calcHist([views.get(space)], _channels(space, views.rgb), None, list(bins), _RANGES[space])
+    return cv2.normalize(hist, hist).ravel()
+
+
+# L2-normalized histogram of uniform local binary patterns (radius 1, 8 neighbours)
+def _lbp(views, space, bins):
+    gray = views.get("gray")
+    h, w = gray.shape
+    center = gray[1:-1, 1:-1]
+    codes = np.zeros(center.shape, dtype=np.uint8)
+    for bit, (dy, dx) in enumerate(_LBP_OFFSETS):
+        codes |= (gray[1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx] >= center).view(np.uint8) << bit
+    hist = np.bincount(_LBP_TABLE[codes].ravel(), minlength=LBP_BINS).astype(np.float32)
+    return hist / max(float(np.linalg.norm(hist)), 1e-12)
+
+
+# Mean, standard deviation and skewness (cube root of the third central moment)
+# of each channel, scaled to roughly 0..1
+def _moments(views, space, bins):
+    image = views.get(space)
+    mean, std = cv2.meanStdDev(image)
+    centered = cv2.subtract(image.astype(np.float32), tuple(mean.ravel()) + (0.0,))
+    skew = np.cbrt(cv2.mean(cv2.multiply(cv2.multiply(centered, centered), centered))[:3])
+    order = _channels(space, views.rgb)
+    return np.concatenate([mean.ravel()[order], std.ravel()[order], skew[order]]) / 255
+
+
+_BLOCKS = {"hist": _hist, "lbp": _lbp, "moments": _moments}
+
+
+# The resized image and its color conversions, each computed at most once per image
+class _Views:
+    def __init__(self, image, rgb):
+        self.rgb = rgb
+        self.cache = {"bgr": image}
+
+    def get(self, space):
+        view = self.cache.get(space)
+        if view is None:
+            view = cv2.cvtColor(self.cache["bgr"], _CONVERSIONS[(space, self.rgb)])
+            self.cache[space] = view
+        return view
+
+
+# A named, versioned list of feature blocks, each (kind, color space, bins):
+#   ("hist", space, (b1, b2, b3)) - joint 3-D color histogram
+#   ("lbp", "gray", None)         - uniform LBP texture histogram
+#   ("moments", space, None)      - per-channel color moments
+# The version identifies cached features and trained models; change it whenever the
+# extraction of an existing set changes.
+# The resize to IMAGE_SIZE averages over each source area (INTER_AREA), so it gives the
+# same image from a full-resolution decode (training) as from a reduced-scale JPEG decode
+# (serving, see inference.read_image); texture blocks like LBP would not survive the
+# aliasing of a bilinear downscale from a large photo.
+class FeatureSet:
+    def __init__(self, name, version, blocks, interpolation=cv2.INTER_AREA):
+        self.name = name
+        self.version = version
+        self.blocks = blocks
+        self.interpolation = interpolation
+        sizes = [self._block_size(kind, bins) for kind, _, bins in blocks]
+        self.offsets = np.cumsum([0] + sizes)
+        self.dim = int(self.offsets[-1])
+
+    @staticmethod
+    def _block_size(kind, bins):
+        if kind == "hist":
+            return int(np.prod(bins))
+        return LBP_BINS if kind == "lbp" else 9
+
+    # Feature vector (float32) of a BGR image, or of an RGB one with rgb=True.
+    # The image is resized once into a per-thread buffer and every block reads from it.
+    def extract(self, image, rgb=False):
+        with stage("resize"):
+            small = cv2.resize(image, IMAGE_SIZE, getattr(_buffers, "resized", None),
+                               interpolation=self.interpolation)
+        _buffers.resized = small  # OpenCV writes into the buffer when it fits
+        views = _Views(small, rgb)
+        out = np.empty(self.dim, dtype=np.float32)
+        with stage("features"):
+            for (kind, space, bins), start, end in zip(self.blocks, self.offsets, self.offsets[1:]):
+                out[start:end] = _BLOCKS[kind](views, space, bins)
+        return out
+
+
+# Per-thread scratch buffer for the resize, reused across images
+_buffers = threading.local()
+
+
+FEATURE_SETS = {
+    fs.name: fs for fs in [
+        # The original 8x8x8 BGR histogram (models trained before feature sets existed),
+        # with its original bilinear resize
+        FeatureSet("bgr-hist", "bgr-hist-8x8x8", [("hist", "bgr", (8, 8, 8))], cv2.INTER_LINEAR),
+        FeatureSet("hsv-hist", "hsv-hist-16x4x4-v2", [("hist", "hsv", (16, 4, 4))]),
+        FeatureSet("lab-hist", "lab-hist-4x8x8-v2", [("hist", "lab", (4, 8, 8))]),
+        FeatureSet("hsv-lbp-moments", "hsv-lbp-moments-v2",
+                   [("hist", "hsv", (16, 4, 4)), ("lbp", "gray", None), ("moments", "hsv", None)]),
+        FeatureSet("lab-lbp-moments", "lab-lbp-moments-v2",
+                   [("hist", "lab", (4, 8, 8)), ("lbp", "gray", None), ("moments", "lab", None)]),
+    ]
+}
+
+# Used by train_knn.py for new models. Only switch once bench_features.py shows another
+# set is more accurate on the real dataset and decode_parity.py passes for it.
+DEFAULT_FEATURE_SET = "bgr-hist"
+
+# Assumed for model artifacts that don't record their feature set
+LEGACY_FEATURE_SET = "bgr-hist"
+
+
+def get_feature_set(name):
+    try:
+        return FEATURE_SETS[name]
+    except KeyError:
+        raise ValueError(f"Unknown feature set {name!r}; choose from {sorted(FEATURE_SETS)}")
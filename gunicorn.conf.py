@@ -0,0 +1,16 @@
+import os
+
+# Multi-worker deployment for either service:
+#   gunicorn app:app     (plant disease API)
+#   gunicorn main:app    (AQI forecast API)
+# The app is imported once in the master with PRELOAD_MODELS=1, so the models are
+# loaded before fork and the workers share those pages copy-on-write.
+# For main:app, one worker at a time retrains the model (and runs AQI_COLLECTOR); the
+# others load what it saves (see REFRESH_LOCK_FILE in main.py).
+os.environ.setdefault("PRELOAD_MODELS", "1")
+preload_app = True
+
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+timeout = 120
@@ -0,0 +1,207 @@
+import os
+import logging
+import io
+import numpy as np
+import joblib
+from PIL import Image
+from neighbor_index import vote, load_index
+from features import get_feature_set, LEGACY_FEATURE_SET
+from metrics import stage
+
+# Model artifacts produced by train_knn.py
+MODEL_STORE_PATH = "knn_store"
+MODEL_PATH = "knn_model.pkl"
+LABEL_ENCODER_PATH = "label_encoder.pkl"
+SCALER_PATH = "scaler.pkl"
+# Optional early-exit cascade saved next to the index (see cascade.py); CASCADE_ENABLED=0 ignores it
+CASCADE_PATH = os.path.join(MODEL_STORE_PATH, "cascade.pkl")
+CASCADE_ENABLED = os.environ.get("CASCADE_ENABLED", "1") == "1"
+
+# Loaded once per process (the API process, or each worker of a process pool)
+knn_model = None
+class_names = None
+scaler_mean = None
+scaler_scale = None
+# Optional reduction stage with the scaler folded in: (matrix, offset) or None
+projection = None
+# The features the model was trained on (see features.py)
+feature_set = get_feature_set(LEGACY_FEATURE_SET)
+# Cheap classifiers run ahead of the neighbor search, or None
+cascade = None
+# Image key (path or ZIP member) of each training row, or None when the model has none
+train_keys = None
+# Training row of each index row when the index holds a condensed reference set (-1 for
+# a k-means prototype), or None when index rows are the training rows
+reference_ids = None
+
+
+# Load the trained model and preprocessing objects into this process
+def load_models():
+    global knn_model, class_names, scaler_mean, scaler_scale, projection, feature_set, cascade
+    global train_keys, reference_ids
+    # Prefer the memory-mapped model store built by train_knn.py; its arrays are
+    # shared between workers through the page cache instead of copied per process
+    if os.path.isdir(MODEL_STORE_PATH):
+        stored = load_index(MODEL_STORE_PATH)
+        knn_model, class_names = stored.index, stored.class_names
+        scaler_mean, scaler_scale, projection = stored.scaler_mean, stored.scaler_scale, stored.projection
+        train_keys, reference_ids = stored.train_keys, stored.reference_ids
+        feature_set = get_feature_set(stored.feature_set)
+        dims = f"{projection[0].shape[0]}->{projection[0].shape[1]} dims" if projection is not None else "no reduction"
+        logging.info(f"Model store loaded from {MODEL_STORE_PATH} "
+                     f"({type(knn_model).__name__}, {knn_model.dtype}, {feature_set.name} features, {dims})")
+        cascade = joblib.load(CASCADE_PATH) if CASCADE_ENABLED and os.path.exists(CASCADE_PATH) else None
+        if cascade is not None:
+            logging.info(f"Cascade loaded: {' -> '.join(cascade_stages())}")
+        return
+
+    # Fall back to the plain pickled KNeighborsClassifier
+    knn_model = joblib.load(MODEL_PATH)
+    label_encoder = joblib.load(LABEL_ENCODER_PATH)
+    scaler = joblib.load(SCALER_PATH)
+    class_names = label_encoder.classes_
+    scaler_mean, scaler_scale, projection, cascade = scaler.mean_, scaler.scale_, None, None
+    train_keys, reference_ids = None, None
+    feature_set = get_feature_set(getattr(scaler, "feature_set_", LEGACY_FEATURE_SET))
+    logging.info(f"Model, label encoder, and scaler loaded successfully ({feature_set.name} features).")
+
+
+# Models a prediction can come from, in the order they run
+def cascade_stages():
+    return (cascade.names if cascade is not None else []) + ["knn"]
+
+
+# What is loaded in this process, for the readiness endpoint
+def model_summary():
+    return {
+        "type": type(knn_model).__name__,
+        "dtype": str(getattr(knn_model, "dtype", "float64")),
+        "samples": int(knn_model.n_samples_fit_),
+        "classes": len(class_names),
+        "features": feature_set.version,
+        "dims": int(projection[0].shape[1]) if projection is not None else len(scaler_mean),
+        "stages": cascade_stages(),
+    }
+
+
+# Same transform as the fitted StandardScaler, followed by the reduction stage when the
+# model has one; the two are fused into a single matrix multiply
+def scale_features(features):
+    if projection is not None:
+        matrix, offset = projection
+        return features @ matrix + offset
+    return (features - scaler_mean) / scaler_scale
+
+
+# Feature extraction with the model's feature set. rgb=True takes an RGB array, which
+# gives the same vector as the BGR image training reads, without converting it.
+def extract_features(image, rgb=False):
+    try:
+        return feature_set.extract(image, rgb)
+    except Exception as e:
+        logging.warning(f"Error extracting features: {e}")
+        return None
+
+
+# JPEG uploads are decoded straight at a reduced scale (1/2 to 1/8, in the DCT domain)
+# as long as the result stays at least this large; the 64x64 resize does the rest
+DRAFT_SIZE = (256, 256)
+
+
+# Decode uploaded bytes into an RGB array
+def read_image(contents):
+    image = Image.open(io.BytesIO(contents))
+    image.draft("RGB", DRAFT_SIZE)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+
+# Decode + extract in one call so it can be shipped to a worker as a single task
+def image_features(contents):
+    try:
+        with stage("decode"):
+            image_rgb = read_image(contents)
+    except Exception as e:
+        raise ValueError(f"Failed to read image: {e}")
+    features = extract_features(image_rgb, rgb=True)
+    if features is None:
+        raise ValueError("Failed to extract features from image")
+    return features
+
+
+# Where an index row came from: its training row and image key, or a prototype flag for
+# a k-means centroid of a condensed reference set
+def neighbor_source(j):
+    row = int(j) if reference_ids is None else int(reference_ids[j])
+    if row < 0:
+        return {"prototype": True}
+    return {"index": row, "key": None if train_keys is None else str(train_keys[row])}
+
+
+# Label (index into classes_) of each neighbor returned by kneighbors()
+def neighbor_labels(model, ind):
+    if hasattr(model, "labels"):
+        return model.labels(ind)
+    return model._y[ind]  # KNeighborsClassifier keeps the encoded training labels here
+
+
+# Predict a whole (N, d) feature matrix with one scaler pass and one neighbor search.
+# Class, confidence and probabilities all come from the same kneighbors() result;
+# top_k > 0 additionally returns the nearest neighbors for explainability: their training
+# row, the image it came from ("key", when the model store records it), distance and label
+# (see neighbor_source).
+# With a cascade, its stages answer the rows they are confident about first and only
+# the rest are searched; results then name the model that answered ("model"). Requests
+# for neighbors skip the cascade and always go through the search.
+def predict_batch(features, top_k=0):
+    with stage("scale"):
+        features = scale_features(features)
+    n_classes = len(knn_model.classes_)
+    use_cascade = cascade is not None and not top_k
+    if use_cascade:
+        pred_proba, exited = cascade.run(features)
+        pred_proba = pred_proba[:, knn_model.classes_]  # label indices -> index class order
+    else:
+        pred_proba, exited = np.zeros((len(features), n_classes)), np.full(len(features), -1)
+    rest = np.flatnonzero(exited < 0)
+
+    k = knn_model.n_neighbors
+    if len(rest):
+        with stage("knn"):
+            queries = features if len(rest) == len(features) else features[rest]
+            dist, ind = knn_model.kneighbors(queries, n_neighbors=max(k, top_k))
+        with stage("vote"):
+            labels = neighbor_labels(knn_model, ind)
+            weighted = getattr(knn_model, "weights", "uniform") == "distance"
+            pred_proba[rest] = vote(labels[:, :k], n_classes, dist[:, :k] if weighted else None)
+    pred_classes = class_names[knn_model.classes_[np.argmax(pred_proba, axis=1)]]
+    stages = cascade_stages()
+
+    results = []
+    for i, (pred_class, proba) in enumerate(zip(pred_classes, pred_proba)):
+        result = {
+            "predicted_class": str(pred_class),
+            "confidence": float(np.max(proba)),
+            "all_probabilities": proba.tolist(),
+        }
+        if use_cascade:
+            result["model"] = stages[exited[i]]  # -1 (no early exit) is the final knn
+        if top_k:
+            neighbor_classes = class_names[knn_model.classes_[labels[i, :top_k]]]
+            result["neighbors"] = [
+                {**neighbor_source(j), "distance": float(d), "label": str(label)}
+                for j, d, label in zip(ind[i, :top_k], dist[i, :top_k], neighbor_classes)
+            ]
+        results.append(result)
+    return results
+
+
+# Predict a single feature vector
+def predict_one(features, top_k=0):
+    return predict_batch(np.asarray(features)[None, :], top_k)[0]
+
+
+# Full single-image pipeline: decode, extract, scale, predict
+def predict_image(contents, top_k=0):
+    return predict_one(image_features(contents), top_k)
@@ -0,0 +1,88 @@
+import time
+import logging
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.neighbors import NearestNeighbors
+from neighbor_index import METRICS, WEIGHTS
+
+# Default selection grid; every (metric, weights, k) combination is scored
+K_CANDIDATES = [1, 3, 5, 7, 9, 11, 15, 21, 31]
+
+
+# Neighbors of every query at the largest k, computed once per metric. Brute force
+# with n_jobs spreads the query chunks over all cores.
+def neighbor_graph(X_train, X_query, k, metric, n_jobs=-1):
+    nn = NearestNeighbors(n_neighbors=k, metric=metric, algorithm="brute", n_jobs=n_jobs).fit(X_train)
+    return nn.kneighbors(X_query)
+
+
+# Number of correct predictions for each (weights, k), from one metric's neighbor graph.
+# Votes are accumulated along the neighbor axis (cumulative sums), so the class scores
+# for every k come out of one pass; ties go to the lowest class, as in
+# KNeighborsClassifier. Rows are processed in chunks to bound the (rows, k, classes) buffer.
+def score_graph(dist, ind, y_train, y_val, n_classes, ks, weightings, chunk_size=1024):
+    labels = y_train[ind]
+    k_max = labels.shape[1]
+    at_k = np.asarray(ks) - 1
+    correct = {w: np.zeros(len(ks), dtype=np.int64) for w in weightings}
+    for start in range(0, len(labels), chunk_size):
+        lab = labels[start:start + chunk_size]
+        d = dist[start:start + chunk_size]
+        truth = y_val[start:start + chunk_size, None]
+        onehot = np.zeros((len(lab), k_max, n_classes), dtype=np.float32)
+        np.put_along_axis(onehot, lab[:, :, None], 1.0, axis=2)
+
+        for weights in weightings:
+            if weights == "uniform":
+                scores = np.cumsum(onehot, axis=1)
+            else:
+                # Inverse distance; within the first k, exact matches (if any) outvote everything
+                exact = d == 0
+                with np.errstate(divide="ignore"):
+                    w = np.where(exact, 0.0, 1.0 / d).astype(np.float32)
+                scores = np.cumsum(onehot * w[:, :, None], axis=1)
+                exact_scores = np.cumsum(onehot * exact[:, :, None], axis=1)
+                has_exact = np.cumsum(exact, axis=1) > 0
+                scores = np.where(has_exact[:, :, None], exact_scores, scores)
+            pred = scores[:, at_k, :].argmax(axis=2)
+            correct[weights] += (pred == truth).sum(axis=0)
+    return correct
+
+
+# Score the whole grid on a validation split. Returns the report: one entry per
+# configuration (sorted best first) plus the time spent on graphs and on scoring.
+def sweep(X_train, y_train, X_val, y_val, ks=None, weightings=WEIGHTS, metrics=METRICS, n_jobs=-1):
+    ks = sorted(set(ks or K_CANDIDATES))
+    ks = [k for k in ks if k <= len(X_train)]
+    n_classes = int(max(y_train.max(), y_val.max())) + 1
+
+    graphs, graph_seconds = {}, {}
+    for metric in metrics:
+        start = time.perf_counter()
+        graphs[metric] = neighbor_graph(X_train, X_val, ks[-1], metric, n_jobs)
+        graph_seconds[metric] = time.perf_counter() - start
+        logging.info(f"{metric} neighbor graph (k={ks[-1]}) in {graph_seconds[metric]:.2f}s")
+
+    start = time.perf_counter()
+    scored = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(score_graph)(dist, ind, y_train, y_val, n_classes, ks, weightings)
+        for dist, ind in graphs.values())
+    score_seconds = time.perf_counter() - start
+
+    results = []
+    for metric, correct in zip(graphs, scored):
+        for weights in weightings:
+            for k, hits in zip(ks, correct[weights]):
+                results.append({"metric": metric, "weights": weights, "k": k, "accuracy": float(hits / len(y_val))})
+    # Best accuracy first; among equals prefer the smaller k, then the grid order
+    order = {(m, w): i for i, (m, w) in enumerate((m, w) for m in metrics for w in weightings)}
+    results.sort(key=lambda r: (-r["accuracy"], r["k"], order[(r["metric"], r["weights"])]))
+    return {
+        "grid": {"k": ks, "weights": list(weightings), "metrics": list(metrics)},
+        "configurations": len(results),
+        "validation_size": len(y_val),
+        "graph_seconds": graph_seconds,
+        "score_seconds": score_seconds,
+        "best": results[0],
+        "results": results,
+    }
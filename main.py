@@ -1,6 +1,35 @@
-from fastapi import FastAPI
+import os
+import asyncio
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows: no gunicorn, so this is the only process
+    fcntl = None
+from datetime import datetime
+from fastapi import FastAPI, HTTPException, Path, Query
 from fastapi.middleware.cors import CORSMiddleware
-from predictor import train_model, predict_next_hours
+from fastapi.responses import JSONResponse
+from predictor import (load_or_train_model, refresh_if_stale, predict_next_hours, resolve_city, load_artifact,
+                       artifact_stamp, MAX_FORECAST_HOURS)
+from aqi_store import store_version
+from aqi_fetcher import run_collector, COLLECT_INTERVAL, CITIES
+from model_registry import ModelRegistry, ModelNotReady, PRELOAD_ENV
+
+# Background model refresh: how often to look for new data, and how many new rows it takes
+MODEL_REFRESH_INTERVAL = float(os.environ.get("MODEL_REFRESH_INTERVAL", 60))
+RETRAIN_MIN_ROWS = int(os.environ.get("RETRAIN_MIN_ROWS", 20))
+
+# AQI_COLLECTOR=1 runs the collector inside the API, in the process holding the refresh
+# lock; otherwise run `python aqi_fetcher.py --daemon` next to it and the new data is
+# picked up all the same
+RUN_COLLECTOR = os.environ.get("AQI_COLLECTOR", "0") == "1"
+
+# With several workers (gunicorn.conf.py), only the one holding this lock retrains, saves
+# the model and runs the collector; the others load the model it saves
+REFRESH_LOCK_FILE = "data/.refresh.lock"
+
+# City served by the legacy /predict/{hours} route
+DEFAULT_CITY = os.environ.get("AQI_DEFAULT_CITY", CITIES[0])
 
 app = FastAPI()
 
@@ -12,8 +41,202 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-model = train_model()
+# The persisted model (refreshed incrementally if new rows arrived, trained only when there
+# is none) loads after startup, in the background, unless PRELOAD_MODELS=1 asks for it
+# here, before gunicorn forks the workers. Refreshed models are built off to the side and
+# swapped into the registry, so a request sees either the old model or the complete new one.
+models = ModelRegistry()
+models.register("aqi", load_or_train_model)
+if os.environ.get(PRELOAD_ENV, "0") == "1":
+    models.preload()
+
+background_tasks = []
+refresh_requested = None
+refresh_lock = None  # the open lock file, once this process holds the refresh lock
+
+
+# Forecasts for the current hour, keyed by (city, hours, intervals). Entries from an
+# earlier hour are dropped as the clock moves on, and everything is dropped when new
+# observations land, so repeated polls within an hour are served from memory.
+class ForecastCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bucket = None
+        self.generation = 0  # bumped on clear, so results computed before it are not stored
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bucket, key, compute):
+        with self.lock:
+            if bucket != self.bucket:
+                self.bucket, self.entries = bucket, {}
+            value = self.entries.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self.generation
+        value = compute()
+        with self.lock:
+            if bucket == self.bucket and generation == self.generation:
+                self.entries[key] = value
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries = {}
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+forecast_cache = ForecastCache()
+
+
+# Take the refresh lock without waiting; it is held until the process exits
+def take_refresh_lock():
+    global refresh_lock
+    if fcntl is None:
+        return True
+    os.makedirs(os.path.dirname(REFRESH_LOCK_FILE), exist_ok=True)
+    f = open(REFRESH_LOCK_FILE, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    refresh_lock = f
+    return True
+
+
+# (stamp, model): the saved model when the artifact changed since `seen`, else None
+def reload_saved_model(seen):
+    stamp = artifact_stamp()
+    if stamp is None or stamp == seen:
+        return seen, None
+    artifact = load_artifact()
+    return stamp, None if artifact is None else artifact["model"]
+
+
+# Until this process holds the refresh lock, follow the model the process that holds it
+# saves, and drop cached forecasts when new observations land. Takes over the lock (and
+# the refresh) when that process exits.
+async def follow_refresh():
+    seen = await asyncio.to_thread(artifact_stamp) if models.ready else None
+    version = await asyncio.to_thread(store_version)
+    while not await asyncio.to_thread(take_refresh_lock):
+        await asyncio.sleep(MODEL_REFRESH_INTERVAL)
+        seen, new_model = await asyncio.to_thread(reload_saved_model, seen)
+        if new_model is not None:
+            models.set("aqi", new_model)
+            print("Loaded saved model")
+        current = await asyncio.to_thread(store_version)
+        if new_model is not None or current != version:
+            version = current
+            forecast_cache.clear()
+
+
+# Watch the observation store and retrain in a worker thread when enough rows have arrived
+async def refresh_loop():
+    await follow_refresh()
+    if RUN_COLLECTOR:
+        background_tasks.append(asyncio.create_task(
+            run_collector(interval=COLLECT_INTERVAL, on_saved=lambda added: refresh_requested.set())))
+    await asyncio.to_thread(models.load_all)
+    seen = await asyncio.to_thread(store_version)
+    while True:
+        try:
+            await asyncio.wait_for(refresh_requested.wait(), MODEL_REFRESH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        refresh_requested.clear()
+
+        # The first load failed (e.g. no data yet); keep retrying
+        if not models.ready:
+            await asyncio.to_thread(models.load_all)
+            seen = await asyncio.to_thread(store_version)
+            continue
+
+        current = await asyncio.to_thread(store_version)
+        if current == seen:
+            continue
+        forecast_cache.clear()
+        try:
+            new_model = await asyncio.to_thread(refresh_if_stale, RETRAIN_MIN_ROWS)
+        except Exception as e:
+            print("Model refresh failed:", e)
+            continue
+        seen = current
+        if new_model is not None:
+            models.set("aqi", new_model)
+            forecast_cache.clear()
+            print("Swapped in refreshed model")
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    global refresh_requested
+    refresh_requested = asyncio.Event()
+    background_tasks.append(asyncio.create_task(refresh_loop()))
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+
+
+# 503 until the model is loaded, instead of holding requests while it trains
+def current_model():
+    try:
+        return models.get("aqi", wait=False)
+    except ModelNotReady as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+
+def forecast(city, hours, intervals):
+    current = current_model()
+    name = resolve_city(current, city)
+    if name is None:
+        raise HTTPException(status_code=404, detail=f"Unknown city: {city}")
+    start = datetime.now().replace(minute=0, second=0, microsecond=0)
+    return forecast_cache.get(start, (name, hours, intervals), lambda: predict_next_hours(
+        current, hours, city=name, intervals=intervals, start=start))
+
+
+# Liveness: the process is up, whether or not the model is loaded yet
+@app.get("/health")
+def get_health():
+    return {"status": "API is running"}
+
+
+# Readiness: 200 once the model is loaded, 503 (with its load state) before that
+@app.get("/ready")
+def get_ready():
+    content = {"ready": models.ready, "models": models.status()}
+    return JSONResponse(status_code=200 if models.ready else 503, content=content)
+
+
+@app.get("/cities")
+def get_cities():
+    return {"cities": list(current_model().cities_), "default": DEFAULT_CITY}
+
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    return forecast_cache.stats()
+
+
+# Forecast from the city's latest observed weather and pm25 history.
+# ?intervals=true adds aqi_low/aqi_high bands from the per-tree spread
+@app.get("/predict/{city}/{hours}")
+def get_city_prediction(city: str, hours: int = Path(..., ge=1, le=MAX_FORECAST_HOURS), intervals: bool = Query(False)):
+    return forecast(city, hours, intervals)
+
 
 @app.get("/predict/{hours}")
-def get_prediction(hours: int):
-    return predict_next_hours(model, hours)
+def get_prediction(hours: int = Path(..., ge=1, le=MAX_FORECAST_HOURS), intervals: bool = Query(False)):
+    return forecast(DEFAULT_CITY, hours, intervals)
@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import bisect
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# Latency histogram buckets in seconds (Prometheus "le" bounds)
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Process-wide registry of labelled histograms and counters, rendered in the
+# Prometheus text exposition format
+class Registry:
+    def __init__(self):
+        self.histograms = {}  # (name, label_name) -> {label_value: Histogram}
+        self.counters = {}    # (name, label_name) -> Counter
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, label_name, label_value, value):
+        with self._lock:
+            series = self.histograms.setdefault((name, label_name), {})
+            hist = series.get(label_value)
+            if hist is None:
+                hist = series[label_value] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name, label_name, label_value, amount=1):
+        with self._lock:
+            self.counters.setdefault((name, label_name), Counter())[label_value] += amount
+
+    # Snapshot of a counter's values by label
+    def counter_values(self, name, label_name):
+        with self._lock:
+            return dict(self.counters.get((name, label_name), {}))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for (name, label_name), series in sorted(self.histograms.items()):
+                lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for value, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label_name}="{value}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{label_name}="{value}",le="+Inf"}} {hist.count}')
+                    lines.append(f'{name}_sum{{{label_name}="{value}"}} {hist.sum}')
+                    lines.append(f'{name}_count{{{label_name}="{value}"}} {hist.count}')
+            for (name, label_name), counter in sorted(self.counters.items()):
+                lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for value, count in sorted(counter.items()):
+                    lines.append(f'{name}{{{label_name}="{value}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.help["leafwish_stage_seconds"] = "Time spent in each stage of the inference pipeline"
+registry.help["leafwish_request_seconds"] = "End-to-end request latency by endpoint"
+registry.help["leafwish_requests_total"] = "Requests by endpoint"
+registry.help["leafwish_errors_total"] = "Failed requests by error type"
+registry.help["leafwish_cascade_exits_total"] = "Predictions answered by each stage of the model cascade"
+
+
+# Stage timings are collected per thread while a pipeline call runs, then handed back
+# to the caller. This works the same in the API process and in process-pool workers,
+# whose own registry would never be scraped.
+_local = threading.local()
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        samples = getattr(_local, "samples", None)
+        if samples is not None:
+            samples.append((name, time.perf_counter() - start))
+
+
+# Run func(*args) and return (result, [(stage, seconds), ...])
+def call_with_timings(func, *args):
+    _local.samples = []
+    try:
+        return func(*args), _local.samples
+    finally:
+        _local.samples = None
+
+
+def observe_stages(samples):
+    for name, seconds in samples:
+        registry.observe("leafwish_stage_seconds", "stage", name, seconds)
+
+
+# Sampling profiler: a background thread snapshots every other thread's stack at a fixed
+# interval and counts identical stacks (collapsed "a;b;c count" format, flamegraph-ready).
+# Off by default, switched on and off at runtime.
+class SamplingProfiler:
+    def __init__(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = 0.005
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=0.005):
+        if self.running:
+            return
+        self.interval = interval
+        self.stacks.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def collapsed(self, top=None):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common(top)) + "\n"
+
+
+profiler = SamplingProfiler()
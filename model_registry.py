@@ -0,0 +1,104 @@
+import gc
+import time
+import asyncio
+import logging
+import threading
+
+# Set by gunicorn.conf.py (or by hand) to load every model at import time, in the
+# master process, before workers are forked
+PRELOAD_ENV = "PRELOAD_MODELS"
+
+
+# Raised when a model is requested before it has finished loading (or after it failed)
+class ModelNotReady(Exception):
+    pass
+
+
+class _Entry:
+    def __init__(self, loader):
+        self.loader = loader
+        self.value = None
+        self.state = "pending"  # pending -> loading -> loaded | failed
+        self.error = None
+        self.seconds = None
+        self.lock = threading.Lock()
+
+
+# Named models with their loaders. Nothing is loaded at construction: models come up
+# on first use (get), in a background startup task (start), or eagerly before fork
+# (preload), and the service reports liveness and readiness separately.
+class ModelRegistry:
+    def __init__(self):
+        self._entries = {}
+
+    def register(self, name, loader):
+        self._entries[name] = _Entry(loader)
+
+    # Run the loader once; concurrent callers wait for the same load instead of repeating it
+    def load(self, name):
+        entry = self._entries[name]
+        with entry.lock:
+            if entry.state == "loaded":
+                return entry.value
+            entry.state = "loading"
+            start = time.perf_counter()
+            try:
+                entry.value = entry.loader()
+            except Exception as e:
+                entry.state, entry.error = "failed", f"{type(e).__name__}: {e}"
+                logging.error(f"Loading model {name} failed: {entry.error}")
+                raise
+            entry.state, entry.error = "loaded", None
+            entry.seconds = time.perf_counter() - start
+            logging.info(f"Model {name} loaded in {entry.seconds:.2f}s")
+            return entry.value
+
+    # The loaded model. wait=False never blocks: it raises ModelNotReady unless the model
+    # is already loaded, which is what async endpoints want while a load is in progress.
+    def get(self, name, wait=True):
+        entry = self._entries[name]
+        if entry.state == "loaded":
+            return entry.value
+        if not wait:
+            detail = f"failed to load ({entry.error})" if entry.state == "failed" else entry.state
+            raise ModelNotReady(f"Model {name} is {detail}")
+        return self.load(name)
+
+    # Replace a model in place (e.g. after a background refresh); readers see the old
+    # value or the new one, never a partial update
+    def set(self, name, value):
+        entry = self._entries[name]
+        entry.value = value
+        entry.state, entry.error = "loaded", None
+
+    # Load everything not loaded yet; failures are recorded in status() rather than raised
+    def load_all(self):
+        for name in self._entries:
+            try:
+                self.load(name)
+            except Exception:
+                pass
+        return self.ready
+
+    # Background load from a startup hook, so the server accepts (and answers /health)
+    # while the models come up
+    def start(self):
+        return asyncio.create_task(asyncio.to_thread(self.load_all))
+
+    # Eager load in the parent process. gc.freeze() moves the loaded objects out of the
+    # collector's reach, so forked workers don't touch (and copy) their pages during GC.
+    def preload(self):
+        if not self.load_all():
+            failed = {name: info["error"] for name, info in self.status().items() if info["state"] == "failed"}
+            raise RuntimeError(f"Preloading models failed: {failed}")
+        gc.freeze()
+
+    @property
+    def ready(self):
+        return all(entry.state == "loaded" for entry in self._entries.values())
+
+    def status(self):
+        return {
+            name: {"state": entry.state, "seconds": entry.seconds, "error": entry.error}
+            for name, entry in self._entries.items()
+        }
@@ -0,0 +1,371 @@
+import os
+import json
+import time
+import joblib
+import numpy as np
+from collections import namedtuple
+from sklearn.cluster import MiniBatchKMeans
+from features import LEGACY_FEATURE_SET
+
+
+# Squared euclidean distances between every row of A and every row of B
+def squared_distances(A, B, B_sq=None):
+    if B_sq is None:
+        B_sq = np.einsum("ij,ij->i", B, B)
+    A_sq = np.einsum("ij,ij->i", A, A)
+    d = A_sq[:, None] - 2.0 * (A @ B.T) + B_sq[None, :]
+    return np.maximum(d, 0, out=d)
+
+
+# k smallest entries of each row of a distance matrix, sorted ascending
+def top_k(d, k):
+    k = min(k, d.shape[1])
+    idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+    part = np.take_along_axis(d, idx, axis=1)
+    order = np.argsort(part, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+# Inverse-distance neighbor weights, as KNeighborsClassifier(weights="distance") computes
+# them: a query with exact matches among its neighbors only counts those matches
+def distance_weights(dist):
+    with np.errstate(divide="ignore"):
+        weights = 1.0 / dist
+    exact = np.isinf(weights)
+    exact_rows = exact.any(axis=1)
+    weights[exact_rows] = exact[exact_rows]
+    return weights
+
+
+# Class probabilities from the (N, k) label indices of each query's neighbors; uniform
+# votes, or inverse-distance weighted ones when the (N, k) distances are given
+def vote(labels, n_classes, dist=None):
+    proba = np.zeros((len(labels), n_classes))
+    rows = np.repeat(np.arange(len(labels)), labels.shape[1])
+    weights = 1.0 if dist is None else distance_weights(np.asarray(dist, dtype=np.float64)).ravel()
+    np.add.at(proba, (rows, labels.ravel()), weights)
+    return proba / proba.sum(axis=1, keepdims=True)
+
+
+# Storage types for the reference matrix. int8 uses a symmetric per-dimension scale.
+STORAGE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# Supported KNeighborsClassifier metric/weights settings. Cosine search runs as euclidean
+# search over unit-length rows and reports 1 - cos like scikit-learn does.
+METRICS = ("euclidean", "cosine")
+WEIGHTS = ("uniform", "distance")
+
+
+def _unit_rows(X):
+    return X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+
+
+# Common predict/predict_proba interface shared by all index types.
+# Mirrors KNeighborsClassifier (euclidean or cosine metric, uniform or distance weights)
+# so app.py can use either.
+class NeighborIndex:
+    # Defaults for indexes pickled before these were configurable
+    metric = "euclidean"
+    weights = "uniform"
+    # Rows converted at a time while fitting
+    fit_block_size = 16384
+
+    def __init__(self, n_neighbors=5, dtype="float32", metric="euclidean", weights="uniform"):
+        self.n_neighbors = n_neighbors
+        self.dtype = dtype
+        self.metric = metric
+        self.weights = weights
+
+    def fit(self, X, y):
+        if self.dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage dtype: {self.dtype} (expected one of {sorted(STORAGE_DTYPES)})")
+        if self.metric not in METRICS:
+            raise ValueError(f"Unknown metric: {self.metric} (expected one of {list(METRICS)})")
+        if self.weights not in WEIGHTS:
+            raise ValueError(f"Unknown weights: {self.weights} (expected one of {list(WEIGHTS)})")
+        self.classes_, y_idx = np.unique(y, return_inverse=True)
+        X = np.asarray(X)
+        order = self._fit(X, y_idx.astype(np.int32))
+        self._store(X, order)
+        return self
+
+    # Rows of X as float32, unit length for cosine search
+    def _prepare(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        return _unit_rows(X) if self.metric == "cosine" else X
+
+    # Build the reference matrix in the storage dtype (rows in `order`, when the index
+    # regroups them) block by block, so X is never copied whole and can be a memmap
+    # larger than RAM; a float32 euclidean index keeps X itself. int8 uses a symmetric
+    # per-dimension scale. Norms are taken from the dequantized values so distances
+    # stay consistent with what is stored.
+    def _store(self, X, order=None):
+        blocks = [slice(b, b + self.fit_block_size) for b in range(0, len(X), self.fit_block_size)]
+        rows = lambda block: self._prepare(X[block] if order is None else X[order[block]])
+        if (self.dtype == "float32" and self.metric == "euclidean" and order is None
+                and X.dtype == np.float32 and X.flags.c_contiguous):
+            self._X = X
+        else:
+            if self.dtype == "int8":
+                scale = np.zeros(X.shape[1], dtype=np.float32)
+                for block in blocks:
+                    scale = np.maximum(scale, np.abs(rows(block)).max(axis=0))
+                scale /= 127.0
+                scale[scale == 0] = 1.0
+                self._scale = scale
+            self._X = np.empty(X.shape, dtype=STORAGE_DTYPES[self.dtype])
+            for block in blocks:
+                R = rows(block)
+                if self.dtype == "int8":
+                    R = np.clip(np.rint(R / self._scale), -127, 127)
+                self._X[block] = R
+        self._X_sq = np.empty(len(X), dtype=np.float32)
+        for block in blocks:
+            R = self._rows(block)
+            self._X_sq[block] = np.einsum("ij,ij->i", R, R)
+
+    # Reference rows as float32, dequantizing only the selected slice
+    def _rows(self, sel):
+        rows = self._X[sel]
+        if self.dtype == "int8":
+            return rows.astype(np.float32) * self._scale
+        if self.dtype == "float16":
+            return rows.astype(np.float32)
+        return rows
+
+    @property
+    def n_samples_fit_(self):
+        return len(self._y)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in vars(self).values() if isinstance(a, np.ndarray))
+
+    # Label index (into classes_) of each training row
+    def labels(self, ind):
+        return self._y_by_id[ind]
+
+    def predict_proba(self, X):
+        dist, ind = self.kneighbors(X)
+        return vote(self.labels(ind), len(self.classes_), dist if self.weights == "distance" else None)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    # Returns (distances, indices); indices refer to rows of the X passed to fit()
+    def kneighbors(self, X, n_neighbors=None):
+        k = n_neighbors or self.n_neighbors
+        X = np.ascontiguousarray(np.atleast_2d(X), dtype=np.float32)
+        if self.metric == "cosine":
+            X = _unit_rows(X)
+            d_sq, ind = self._search(X, k)
+            return d_sq / 2, ind  # |a - b|^2 = 2 - 2cos for unit vectors
+        d_sq, ind = self._search(X, k)
+        return np.sqrt(d_sq), ind
+
+
+# Brute-force search. Queries are chunked, and the reference matrix is scanned in
+# blocks so only one block at a time is dequantized and the distance block stays small.
+class ExactIndex(NeighborIndex):
+    chunk_size = 256
+    block_size = 8192
+
+    def _fit(self, X, y):
+        self._y = y
+        self._y_by_id = y
+
+    def _search(self, X, k):
+        dists, inds = [], []
+        for start in range(0, len(X), self.chunk_size):
+            Q = X[start:start + self.chunk_size]
+            best_d = best_i = None
+            for b in range(0, len(self._X), self.block_size):
+                block = slice(b, b + self.block_size)
+                d, i = top_k(squared_distances(Q, self._rows(block), self._X_sq[block]), k)
+                i += b
+                if best_d is not None:
+                    d, j = top_k(np.hstack([best_d, d]), k)
+                    i = np.take_along_axis(np.hstack([best_i, i]), j, axis=1)
+                best_d, best_i = d, i
+            dists.append(best_d)
+            inds.append(best_i)
+        return np.vstack(dists), np.vstack(inds)
+
+
+# Inverted-file index: k-means coarse quantizer, only the n_probe closest lists are scanned per query.
+# The quantizer is trained on at most train_per_list rows per list (a random sample on
+# larger sets), then every row is assigned to its list block by block.
+class IVFIndex(NeighborIndex):
+    train_per_list = 256
+
+    def __init__(self, n_neighbors=5, dtype="float32", n_lists=None, n_probe=8, random_state=42,
+                 metric="euclidean", weights="uniform"):
+        super().__init__(n_neighbors, dtype, metric, weights)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.random_state = random_state
+
+    def _fit(self, X, y):
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(X))))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=self.random_state, n_init=3, batch_size=4096)
+        n_train = self.train_per_list * n_lists
+        if len(X) <= n_train:
+            kmeans.fit(self._prepare(X))
+        else:
+            sample = np.sort(np.random.default_rng(self.random_state).choice(len(X), n_train, replace=False))
+            kmeans.fit(self._prepare(X[sample]))
+        assign = np.concatenate([kmeans.predict(self._prepare(X[b:b + self.fit_block_size]))
+                                 for b in range(0, len(X), self.fit_block_size)])
+        self.centroids_ = kmeans.cluster_centers_.astype(np.float32)
+        self._centroids_sq = np.einsum("ij,ij->i", self.centroids_, self.centroids_)
+
+        # Store rows grouped by list so each list is one contiguous slice
+        order = np.argsort(assign, kind="stable")
+        self._y = y[order]
+        self._ids = order.astype(np.int64)
+        self._y_by_id = y
+        counts = np.bincount(assign, minlength=n_lists)
+        self._offsets = np.concatenate([[0], np.cumsum(counts)])
+        return order
+
+    def _search(self, X, k):
+        n_probe = min(self.n_probe, len(self.centroids_))
+        _, probes = top_k(squared_distances(X, self.centroids_, self._centroids_sq), n_probe)
+        dists = np.full((len(X), k), np.inf, dtype=np.float32)
+        inds = np.zeros((len(X), k), dtype=np.int64)
+        for q, lists in enumerate(probes):
+            cand = np.concatenate([np.arange(self._offsets[l], self._offsets[l + 1]) for l in lists])
+            if len(cand) < k:
+                cand = np.arange(len(self._X))
+            d = squared_distances(X[q:q + 1], self._rows(cand), self._X_sq[cand])
+            d, i = top_k(d, k)
+            dists[q] = d[0]
+            inds[q] = self._ids[cand[i[0]]]
+        return dists, inds
+
+
+INDEX_TYPES = {"exact": ExactIndex, "ivf": IVFIndex}
+
+
+def build_index(kind, X, y, n_neighbors=5, **params):
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {kind} (expected one of {sorted(INDEX_TYPES)})")
+    return INDEX_TYPES[kind](n_neighbors=n_neighbors, **params).fit(X, y)
+
+
+# Model store layout (one directory):
+#   index.pkl            - the index object without its arrays
+#   <array>.npy          - every array of the index (quantized reference matrix, labels, lists, ...)
+#   scaler_mean.npy,
+#   scaler_scale.npy     - StandardScaler parameters
+#   projection_matrix.npy,
+#   projection_offset.npy - optional reduction stage, fused with the scaler (see reduction.py)
+#   train_keys.npy       - optional image key (path or ZIP member) of each training row
+#   reference_ids.npy    - optional training row of each index row, for an index fitted on a
+#                          condensed reference set (-1: a prototype, no training row); without
+#                          it, index rows are the training rows
+#   meta.json            - class names, feature set, reduction, storage dtype, sizes
+# Arrays are saved as plain .npy so they can be memory-mapped read-only at load time.
+# projection, when given, is a dict with kind, n_components, matrix and offset.
+# Every file is written under a temporary name and renamed into place, meta.json last:
+# a server that has the old arrays memory-mapped keeps reading the old files, never a
+# half-written one. Arrays left over from a previous store of another kind are removed.
+def save_index(index, path, scaler, class_names, feature_set=LEGACY_FEATURE_SET, projection=None,
+               train_keys=None, reference_ids=None):
+    os.makedirs(path, exist_ok=True)
+    arrays = {name: a for name, a in vars(index).items() if isinstance(a, np.ndarray)}
+    files = {f"{name}.npy": np.ascontiguousarray(a) for name, a in arrays.items()}
+    files["scaler_mean.npy"] = scaler.mean_.astype(np.float32)
+    files["scaler_scale.npy"] = scaler.scale_.astype(np.float32)
+    if projection is not None:
+        files["projection_matrix.npy"] = projection["matrix"].astype(np.float32)
+        files["projection_offset.npy"] = projection["offset"].astype(np.float32)
+    if train_keys is not None:
+        files["train_keys.npy"] = np.asarray(train_keys, dtype=str)
+    if reference_ids is not None:
+        files["reference_ids.npy"] = np.asarray(reference_ids, dtype=np.int64)
+    for name, a in files.items():
+        _replace(os.path.join(path, name), lambda f: np.save(f, a))
+
+    shell = index.__class__.__new__(index.__class__)
+    shell.__dict__.update({name: a for name, a in vars(index).items() if name not in arrays})
+    _replace(os.path.join(path, "index.pkl"), lambda f: joblib.dump(shell, f))
+
+    meta = {
+        "index": type(index).__name__,
+        "dtype": index.dtype,
+        "n_neighbors": index.n_neighbors,
+        "metric": index.metric,
+        "weights": index.weights,
+        "n_samples": int(index.n_samples_fit_),
+        "n_features": int(index._X.shape[1]),
+        "arrays": sorted(arrays),
+        "class_names": [str(c) for c in class_names],
+        "feature_set": feature_set,
+        "reduction": None if projection is None else
+                     {"kind": projection["kind"], "n_components": int(projection["n_components"])},
+        "train_keys": train_keys is not None,
+        "reference_ids": reference_ids is not None,
+    }
+    _replace(os.path.join(path, "meta.json"), lambda f: f.write(json.dumps(meta, indent=2).encode()))
+
+    for name in os.listdir(path):
+        if name.endswith(".npy") and name not in files:
+            os.remove(os.path.join(path, name))
+
+
+# Write a file through write(f) to a temporary name, then rename it over path
+def _replace(path, write):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+# A loaded model store. projection is (matrix, offset) or None, train_keys the image
+# key of each training row or None, reference_ids the training row of each index row
+# or None; see save_index.
+StoredModel = namedtuple("StoredModel", "index scaler_mean scaler_scale class_names feature_set projection "
+                                        "train_keys reference_ids")
+
+
+# Load a model store; with mmap=True the arrays are shared read-only through the OS page cache
+def load_index(path, mmap=True):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    mode = "r" if mmap else None
+    index = joblib.load(os.path.join(path, "index.pkl"))
+    for name in meta["arrays"]:
+        setattr(index, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode))
+    scaler_mean = np.load(os.path.join(path, "scaler_mean.npy"))
+    scaler_scale = np.load(os.path.join(path, "scaler_scale.npy"))
+    projection = None
+    if meta.get("reduction"):
+        projection = (np.load(os.path.join(path, "projection_matrix.npy")),
+                      np.load(os.path.join(path, "projection_offset.npy")))
+    train_keys = np.load(os.path.join(path, "train_keys.npy"), mmap_mode=mode) if meta.get("train_keys") else None
+    reference_ids = None
+    if meta.get("reference_ids"):
+        reference_ids = np.load(os.path.join(path, "reference_ids.npy"), mmap_mode=mode)
+    return StoredModel(index, scaler_mean, scaler_scale, np.array(meta["class_names"]),
+                       meta.get("feature_set", LEGACY_FEATURE_SET), projection, train_keys, reference_ids)
+
+
+# Recall@k and latency of an index against exact search on a held-out set
+def evaluate_index(index, exact, X, y, batch_size=1, max_queries=2000):
+    X, y = X[:max_queries], y[:max_queries]
+    k = index.n_neighbors
+    _, truth = exact.kneighbors(X, k)
+
+    start = time.perf_counter()
+    inds = [index.kneighbors(X[i:i + batch_size], k)[1] for i in range(0, len(X), batch_size)]
+    elapsed = time.perf_counter() - start
+    inds = np.vstack(inds)
+
+    hits = sum(len(np.intersect1d(a, b)) for a, b in zip(inds, truth))
+    acc = float(np.mean(index.predict(X) == y))
+    return {
+        "recall_at_k": hits / truth.size,
+        "accuracy": acc,
+        "latency_ms_per_query": 1000.0 * elapsed / len(X),
+    }
@@ -0,0 +1,42 @@
+import logging
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import train_test_split
+
+
+# StandardScaler fitted incrementally over (features, labels) chunks, plus the labels
+# of every row in stream order. Only one chunk of features is in memory at a time.
+def fit_scaler(chunks):
+    scaler = StandardScaler()
+    labels, dim = [], None
+    for X, y in chunks:
+        scaler.partial_fit(X)
+        labels.append(y)
+        dim = X.shape[1]
+    if not labels:
+        return scaler, np.array([]), 0
+    return scaler, np.concatenate(labels), dim
+
+
+# Row order train | val | test: the same 70/15/15 split train_test_split makes of an
+# in-memory matrix, so both training paths see identical splits. Returns the order and
+# the train and val sizes.
+def split_order(n, random_state=42):
+    train, temp = train_test_split(np.arange(n), test_size=0.3, random_state=random_state)
+    val, test = train_test_split(temp, test_size=0.5, random_state=random_state)
+    return np.concatenate([train, val, test]), len(train), len(val)
+
+
+# Scale the stream chunk by chunk into a preallocated float32 .npy at path, row i of the
+# stream going to row position[i], and return it memory-mapped read-only. Peak memory
+# is one chunk; the matrix itself lives in the OS page cache.
+def write_scaled(chunks, scaler, path, n, dim, position):
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n, dim))
+    start = 0
+    for X, _ in chunks:
+        out[position[start:start + len(X)]] = scaler.transform(X)
+        start += len(X)
+    out.flush()
+    del out
+    logging.info(f"Scaled features ({n} x {dim}, {n * dim * 4 / 2**20:.1f} MB) written to {path}")
+    return np.load(path, mmap_mode="r")
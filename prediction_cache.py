@@ -0,0 +1,121 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+# Key for the raw upload bytes
+def content_key(contents):
+    return hashlib.blake2b(contents, digest_size=16).digest()
+
+
+# Key for a feature vector quantized to 1/4096, so re-encoded copies of the same
+# photo whose histograms only differ by float noise still hit
+def feature_key(features):
+    q = np.rint(np.asarray(features, dtype=np.float32) * 4096).astype(np.int16)
+    return hashlib.blake2b(q.tobytes(), digest_size=16).digest()
+
+
+# (path, size, mtime) of every model file; a directory contributes all of its files
+def model_fingerprint(paths):
+    entries = []
+    for path in paths:
+        files = [os.path.join(path, f) for f in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        for f in files:
+            try:
+                st = os.stat(f)
+                entries.append((f, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                pass
+    return tuple(entries)
+
+
+# Bounded LRU cache of prediction results with a TTL. It is cleared automatically
+# when any of the watched model files changes (checked at most once per check_interval).
+class PredictionCache:
+    def __init__(self, max_entries=10000, ttl=3600.0, watch_paths=(), check_interval=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.watch_paths = list(watch_paths)
+        self.check_interval = check_interval
+        self._entries = OrderedDict()  # key -> (expires_at, result)
+        self._lock = threading.Lock()
+        self._fingerprint = model_fingerprint(self.watch_paths)
+        self._next_check = time.monotonic() + check_interval
+        self.hits = 0
+        self.feature_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_models(self, now):
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        fingerprint = model_fingerprint(self.watch_paths)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            self._entries.clear()
+            self.invalidations += 1
+
+    def _get(self, key):
+        if self.max_entries <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._check_models(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    # Lookup by upload bytes (first level)
+    def get_content(self, key):
+        result = self._get(key)
+        if result is not None:
+            self.hits += 1
+        return result
+
+    # Lookup by quantized features, after a content miss; a miss here means a full prediction
+    def get_features(self, key):
+        result = self._get(key)
+        if result is not None:
+            self.feature_hits += 1
+        else:
+            self.misses += 1
+        return result
+
+    def put(self, key, result):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.feature_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "feature_hits": self.feature_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.feature_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -1,45 +1,253 @@
+import os
+import joblib
+import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.model_selection import train_test_split
 from datetime import datetime, timedelta
+from aqi_store import load_observations, store_version, migrate_csv, STORE_DIR
 
 CSV_FILE = "data/aqi_data.csv"
+MODEL_FILE = "data/aqi_model.pkl"
 
-def train_model():
-    df = pd.read_csv(CSV_FILE, parse_dates=["datetime"])
+# Bump when the feature set or artifact layout changes; other versions are retrained from scratch
+MODEL_VERSION = 4
+
+# Only these columns are read from the observation store
+TRAIN_COLUMNS = ["datetime", "city", "aqi", "pm25", "temp", "humidity", "wind"]
+
+# Per-city pm25 history used as features: lags and trailing means over previous observations
+PM25_LAGS = [1, 2, 3, 6]
+PM25_WINDOWS = [3, 6, 24]
+CALENDAR = ["hour", "day", "month"]
+# Observed values, held at the city's latest reading when forecasting
+OBSERVED = (["temp", "humidity", "wind", "pm25"]
+            + [f"pm25_lag{lag}" for lag in PM25_LAGS]
+            + [f"pm25_mean{w}" for w in PM25_WINDOWS])
+# city_code indexes model.cities_ (-1 for cities the model was not trained on)
+FEATURES = CALENDAR + ["city_code"] + OBSERVED
+
+# Incremental refresh: new trees are fit on the newest rows (plus recent history so the
+# lag features are complete) and the oldest trees are retired to keep the forest size fixed
+N_ESTIMATORS = 100
+INCREMENT_TREES = 20
+INCREMENT_WINDOW = 5000
+REFRESH_DAYS = 14  # history loaded for a refresh, so the window's lag features are complete
+
+
+# Calendar + per-city lag/rolling features, computed with grouped vectorized ops.
+# Rows must belong to whole city histories (or a tail with enough history before it).
+def build_features(df):
+    df = df.sort_values(["city", "datetime"], kind="stable").reset_index(drop=True)
     df["hour"] = df["datetime"].dt.hour
     df["day"] = df["datetime"].dt.day
     df["month"] = df["datetime"].dt.month
 
-    X = df[["hour","day","month","temp","humidity","wind","pm25"]]
+    by_city = df.groupby("city", sort=False)["pm25"]
+    prev = by_city.shift(1)
+    for lag in PM25_LAGS:
+        df[f"pm25_lag{lag}"] = by_city.shift(lag)
+    prev_by_city = prev.groupby(df["city"], sort=False)
+    for w in PM25_WINDOWS:
+        df[f"pm25_mean{w}"] = prev_by_city.rolling(w, min_periods=1).mean().reset_index(level=0, drop=True)
+
+    # The first observations of a city have no history yet; fall back to the current reading
+    history = [f"pm25_lag{lag}" for lag in PM25_LAGS] + [f"pm25_mean{w}" for w in PM25_WINDOWS]
+    df[history] = df[history].apply(lambda col: col.fillna(df["pm25"]))
+    return df
+
+
+def city_codes(cities, known):
+    return pd.Categorical(cities, categories=known).codes
+
+
+# Import the legacy CSV the first time the Parquet store is needed
+def ensure_store():
+    if not os.path.isdir(STORE_DIR) and os.path.exists(CSV_FILE):
+        print(f"Migrating {CSV_FILE} into {STORE_DIR}")
+        migrate_csv(CSV_FILE)
+
+
+def read_rows(start=None):
+    df = load_observations(columns=TRAIN_COLUMNS, start=start)
+    return df.dropna(subset=["datetime", "aqi"])
+
+
+def train_model(df=None):
+    if df is None:
+        ensure_store()
+        df = read_rows()
+    df = build_features(df)
+    cities = sorted(df["city"].unique())
+    df["city_code"] = city_codes(df["city"], cities)
+
+    X = df[FEATURES]
     y = df["aqi"]
 
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
-    model = RandomForestRegressor(n_estimators=100)
+    model = RandomForestRegressor(n_estimators=N_ESTIMATORS)
     model.fit(X_train, y_train)
-    print("Model trained")
+    model.cities_ = cities
+    print(f"Model trained (R^2 on held-out rows: {model.score(X_test, y_test):.3f})")
     return model
 
-def predict_next_hours(model, hours=6):
-    now = datetime.now()
-    predictions = []
-    for i in range(1, hours+1):
-        future_time = now + timedelta(hours=i)
-        X_future = [[
-            future_time.hour,
-            future_time.day,
-            future_time.month,
-            25,    # placeholder temp
-            60,    # placeholder humidity
-            10,    # placeholder wind
-            50     # placeholder pm25
-        ]]
-        pred = model.predict(X_future)[0]
-        predictions.append({"time": future_time.strftime("%Y-%m-%d %H:%M"), "aqi": round(pred)})
+
+# Add trees fit on the newest rows, retiring the oldest ones. Returns the model and the
+# newest observation time it has seen, or None when fewer than min_new_rows have arrived.
+def refresh_model(model, last_datetime, min_new_rows=1):
+    df = read_rows(start=last_datetime - timedelta(days=REFRESH_DAYS))
+    new_rows = int((df["datetime"] > last_datetime).sum())
+    if new_rows < max(1, min_new_rows):
+        return None
+    df = build_features(df)
+    df["city_code"] = city_codes(df["city"], model.cities_)
+    window = df.sort_values("datetime", kind="stable").tail(INCREMENT_WINDOW)
+
+    model.set_params(warm_start=True, n_estimators=len(model.estimators_) + INCREMENT_TREES)
+    model.fit(window[FEATURES], window["aqi"])
+    model.estimators_ = model.estimators_[-N_ESTIMATORS:]
+    model.set_params(n_estimators=len(model.estimators_), warm_start=False)
+    print(f"Model refreshed with {new_rows} new rows")
+    return model, df["datetime"].max()
+
+
+# Written to a temporary file and renamed over MODEL_FILE, so a reader never loads a
+# half-written artifact
+def save_model(model, last_datetime, version):
+    tmp = f"{MODEL_FILE}.{os.getpid()}.tmp"
+    joblib.dump({
+        "version": MODEL_VERSION,
+        "features": FEATURES,
+        "model": model,
+        "last_datetime": last_datetime,
+        "store_version": version,
+        "trained_at": datetime.now().isoformat(timespec="seconds"),
+    }, tmp)
+    os.replace(tmp, MODEL_FILE)
+
+
+# Changes whenever save_model replaces the artifact; None when there is none
+def artifact_stamp():
+    try:
+        return os.stat(MODEL_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+# The saved artifact, or None when missing, unreadable or from another MODEL_VERSION
+def load_artifact():
+    if not os.path.exists(MODEL_FILE):
+        return None
+    try:
+        artifact = joblib.load(MODEL_FILE)
+    except Exception as e:
+        print("Error loading model, retraining:", e)
+        return None
+    return artifact if artifact.get("version") == MODEL_VERSION else None
+
+
+def train_and_save():
+    version = store_version()
+    df = read_rows()
+    model = train_model(df)
+    save_model(model, df["datetime"].max(), version)
+    return model
+
+
+# Load the persisted model, refreshing it incrementally when the store has new data and
+# retraining from scratch when there is no compatible artifact
+def load_or_train_model():
+    ensure_store()
+    artifact = load_artifact()
+    if artifact is None:
+        return train_and_save()
+    model = refresh_if_stale(artifact=artifact)
+    return model if model is not None else artifact["model"]
+
+
+# A newly refreshed model when the store changed and at least min_new_rows arrived since
+# the last training, otherwise None. The model is always a fresh object loaded from disk,
+# never one that is currently serving, so it can be built in the background and swapped in.
+def refresh_if_stale(min_new_rows=1, artifact=None):
+    artifact = artifact or load_artifact()
+    if artifact is None:
+        return train_and_save()
+    version = store_version()
+    if artifact["store_version"] == version:
+        return None
+    refreshed = refresh_model(artifact["model"], artifact["last_datetime"], min_new_rows)
+    if refreshed is None:
+        return None
+    model, last_datetime = refreshed
+    save_model(model, last_datetime, version)
+    return model
+
+
+# Longest forecast served in one request
+MAX_FORECAST_HOURS = 168
+
+# Fallback inputs for a city without any observations
+PLACEHOLDER_INPUTS = {"temp": 25, "humidity": 60, "wind": 10, "pm25": 50}
+
+# How far back to look for a city's latest reading before scanning its whole history
+LATEST_LOOKBACK_DAYS = 3
+
+
+# Observed features at a city's most recent reading (weather plus pm25 history),
+# or None when the store has no rows for the city
+def latest_inputs(city):
+    columns = ["datetime", "city", "pm25", "temp", "humidity", "wind"]
+    df = load_observations(columns=columns, cities=[city],
+                           start=datetime.now() - timedelta(days=LATEST_LOOKBACK_DAYS))
+    if len(df) <= max(PM25_LAGS + PM25_WINDOWS):
+        df = load_observations(columns=columns, cities=[city])
+    df = df.dropna(subset=["datetime", "pm25"])
+    if df.empty:
+        return None
+    latest = build_features(df).iloc[-1]
+    return {name: float(latest[name]) for name in OBSERVED if pd.notna(latest[name])}
+
+
+# The model's spelling of a city name (matched case-insensitively), or None
+def resolve_city(model, city):
+    known = {name.lower(): name for name in getattr(model, "cities_", [])}
+    return known.get(city.strip().lower())
+
+
+# Forecast hourly AQI for the `hours` hours after `start` (default: the current hour)
+# with a single model.predict call. `city` selects the city and, unless `inputs` are
+# given, its latest observed weather/pm25 values, which are held constant over the
+# horizon (missing pm25 history features default to the pm25 value). With
+# intervals=True, each point also gets a [low, high] band from the spread of the
+# individual trees' predictions.
+def predict_next_hours(model, hours=6, city=None, inputs=None, intervals=False, quantiles=(5, 95), start=None):
+    hours = min(hours, MAX_FORECAST_HOURS)
+    if inputs is None and city is not None:
+        inputs = latest_inputs(city)
+    inputs = {**PLACEHOLDER_INPUTS, **(inputs or {})}
+    start = start or datetime.now().replace(minute=0, second=0, microsecond=0)
+    times = pd.DatetimeIndex([start + timedelta(hours=i) for i in range(1, hours + 1)])
+
+    X_future = pd.DataFrame({"hour": times.hour, "day": times.day, "month": times.month})
+    X_future["city_code"] = city_codes([city], getattr(model, "cities_", []))[0]
+    for name in OBSERVED:
+        X_future[name] = inputs.get(name, inputs["pm25"])
+    X_future = X_future[FEATURES]
+
+    preds = model.predict(X_future)
+    labels = times.strftime("%Y-%m-%d %H:%M")
+    predictions = [{"time": t, "aqi": round(p)} for t, p in zip(labels, preds)]
+    if intervals:
+        per_tree = np.stack([tree.predict(X_future.to_numpy()) for tree in model.estimators_])
+        low, high = np.percentile(per_tree, quantiles, axis=0)
+        for p, lo, hi in zip(predictions, low, high):
+            p["aqi_low"] = round(lo)
+            p["aqi_high"] = round(hi)
     return predictions
 
 if __name__ == "__main__":
-    model = train_model()
-    next_hours = predict_next_hours(model)
-    for p in next_hours:
-        print(p)
+    model = load_or_train_model()
+    for city in model.cities_:
+        print(city)
+        for p in predict_next_hours(model, city=city):
+            print(p)
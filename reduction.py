@@ -0,0 +1,69 @@
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.random_projection import SparseRandomProjection
+from neighbor_index import ExactIndex, evaluate_index
+
+# Reduction stages that can follow the StandardScaler
+REDUCTIONS = ("pca", "random")
+
+# Target dimensionalities tried by the validation sweep (those below the input size)
+SWEEP_COMPONENTS = [8, 16, 24, 32, 48, 64, 96, 128, 192, 256]
+
+
+# Fit a projection of standardized features down to n_components dims, returned as
+# (W, center) with reduced = (X - center) @ W. PCA centers on the training mean;
+# a sparse random projection needs no fitting beyond its seed and is not centered.
+def fit_reduction(kind, X, n_components, random_state=42):
+    if kind == "pca":
+        pca = PCA(n_components=n_components, random_state=random_state).fit(X)
+        return pca.components_.T.astype(np.float32), pca.mean_.astype(np.float32)
+    if kind == "random":
+        srp = SparseRandomProjection(n_components=n_components, random_state=random_state).fit(X)
+        return srp.components_.T.toarray().astype(np.float32), np.zeros(X.shape[1], dtype=np.float32)
+    raise ValueError(f"Unknown reduction: {kind} (expected one of {list(REDUCTIONS)})")
+
+
+def project(X, W, center):
+    return ((X - center) @ W).astype(np.float32)
+
+
+# Fold the scaler into the projection, so serving does one matrix multiply:
+#   ((x - mean) / scale - center) @ W  ==  x @ matrix + offset
+def fuse(scaler_mean, scaler_scale, W, center):
+    matrix = W / scaler_scale[:, None]
+    offset = -((scaler_mean / scaler_scale + center) @ W)
+    return matrix.astype(np.float32), offset.astype(np.float32)
+
+
+# Validation accuracy, per-query latency and index size of exact search, unreduced
+# (first entry) and at each candidate dimensionality; index_params (metric, weights)
+# configure the index like the one that will be served
+def sweep_components(kind, X_train, y_train, X_val, y_val, n_neighbors, candidates=None,
+                     dtype="float32", max_queries=500, **index_params):
+    dim = X_train.shape[1]
+    candidates = [m for m in (candidates or SWEEP_COMPONENTS) if m < min(dim, len(X_train))]
+    results = []
+    for n_components in [None] + candidates:
+        if n_components is None:
+            train, val = X_train, X_val
+        else:
+            W, center = fit_reduction(kind, X_train, n_components)
+            train, val = project(X_train, W, center), project(X_val, W, center)
+        index = ExactIndex(n_neighbors=n_neighbors, dtype=dtype, **index_params).fit(train, y_train)
+        result = evaluate_index(index, index, val, y_val, max_queries=max_queries)
+        results.append({
+            "n_components": n_components or dim,
+            "reduced": n_components is not None,
+            "accuracy": result["accuracy"],
+            "latency_ms_per_query": result["latency_ms_per_query"],
+            "megabytes": index.nbytes / 2**20,
+        })
+    return results
+
+
+# Smallest swept dimensionality whose accuracy is within max_drop of the unreduced
+# search, or None when every reduction costs more than that
+def choose_components(results, max_drop):
+    baseline = results[0]["accuracy"]
+    good = [r["n_components"] for r in results if r["reduced"] and r["accuracy"] >= baseline - max_drop]
+    return min(good) if good else None
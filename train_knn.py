@@ -1,131 +1,325 @@
 import sys
 import os
+import json
+import argparse
 import logging
 import numpy as np
-import cv2
-from pathlib import Path
 from sklearn.preprocessing import LabelEncoder, StandardScaler
 from sklearn.model_selection import train_test_split
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.metrics import accuracy_score, classification_report
 import joblib
-import kagglehub
-import zipfile
+from neighbor_index import build_index, evaluate_index, save_index, ExactIndex, STORAGE_DTYPES, METRICS, WEIGHTS
+from feature_cache import update_cache, iter_chunks, load_dataset, readable_keys
+from out_of_core import fit_scaler, split_order, write_scaled
+from dataset_reader import open_source, DirectorySource
+from features import FEATURE_SETS, DEFAULT_FEATURE_SET
+from reduction import REDUCTIONS, fit_reduction, project, fuse, sweep_components, choose_components
+from knn_sweep import sweep, K_CANDIDATES
+from condensation import METHODS as CONDENSE_METHODS, KMEANS_LEVELS, sweep_condensation, choose_reference
+from cascade import STAGES as CASCADE_STAGES, fit_stages, calibrate, benchmark as benchmark_cascade
 
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Download dataset
-logging.info("Downloading PlantVillage dataset using kagglehub...")
-try:
-    BASE_PATH = kagglehub.dataset_download("abdallahalidev/plantvillage-dataset")
-    logging.info(f"Dataset downloaded to: {BASE_PATH}")
-except Exception as e:
-    logging.error(f"Failed to download dataset: {e}")
-    sys.exit(1)
+# Command line options
+parser = argparse.ArgumentParser(description="Train the plant disease KNN model")
+parser.add_argument("--index", choices=["exact", "ivf"], default="exact",
+                    help="neighbor index saved to the knn_store/ model store for serving; ivf is approximate "
+                         "(faster, may lose accuracy; see the n_probe sweep in knn_index_report.json)")
+parser.add_argument("--n-lists", type=int, default=None,
+                    help="IVF: number of inverted lists (default sqrt of training size)")
+parser.add_argument("--n-probe", type=int, default=8,
+                    help="IVF: lists scanned per query")
+parser.add_argument("--dtype", choices=sorted(STORAGE_DTYPES), default="float16",
+                    help="storage type of the reference features in the model store")
+parser.add_argument("--data", default=None,
+                    help="dataset ZIP or directory, read in place (default: download with kagglehub)")
+parser.add_argument("--subdir", default="color",
+                    help="dataset folder holding the class folders (PlantVillage: color)")
+parser.add_argument("--cache-dir", default="feature_cache",
+                    help="directory of the on-disk feature cache")
+parser.add_argument("--workers", type=int, default=None,
+                    help="feature extraction processes (default: all cores)")
+parser.add_argument("--features", choices=sorted(FEATURE_SETS), default=DEFAULT_FEATURE_SET,
+                    help="feature set (see features.py and bench_features.py)")
+parser.add_argument("--out-of-core", action="store_true",
+                    help="stream features in chunks: incremental scaler fit, scaled matrix memory-mapped from --memmap-path")
+parser.add_argument("--chunk-size", type=int, default=8192,
+                    help="out-of-core: feature rows read per chunk")
+parser.add_argument("--memmap-path", default="train_features.npy",
+                    help="out-of-core: file backing the scaled feature matrix")
+parser.add_argument("--k", type=int, nargs="+", default=K_CANDIDATES,
+                    help="neighbor counts tried by the model-selection sweep")
+parser.add_argument("--weights", nargs="+", choices=WEIGHTS, default=list(WEIGHTS),
+                    help="vote weightings tried by the sweep")
+parser.add_argument("--metrics", nargs="+", choices=METRICS, default=list(METRICS),
+                    help="distance metrics tried by the sweep")
+parser.add_argument("--sweep-jobs", type=int, default=-1,
+                    help="cores used by the sweep (default: all)")
+parser.add_argument("--reduce", choices=["none", *REDUCTIONS], default="none",
+                    help="dimensionality reduction after the scaler, baked into knn_store/")
+parser.add_argument("--components", type=int, default=None,
+                    help="reduced dimensionality (default: chosen by a validation sweep)")
+parser.add_argument("--max-accuracy-drop", type=float, default=0.01,
+                    help="sweep: largest validation accuracy loss accepted for a smaller dimensionality")
+parser.add_argument("--condense", choices=["none", *CONDENSE_METHODS, "all"], default="none",
+                    help="shrink the reference set of the serving index (see condensation.py)")
+parser.add_argument("--condense-tolerance", type=float, default=0.01,
+                    help="largest validation accuracy loss accepted for a smaller reference set")
+parser.add_argument("--condense-levels", type=float, nargs="+", default=KMEANS_LEVELS,
+                    help="kmeans: prototypes per class, as fractions of the class size")
+parser.add_argument("--cascade", choices=["none", *CASCADE_STAGES, "+".join(CASCADE_STAGES)], default="none",
+                    help="cheap classifiers served ahead of the neighbor search (see cascade.py)")
+parser.add_argument("--cascade-tolerance", type=float, default=0.005,
+                    help="largest validation accuracy loss accepted from early exits")
 
 
-# Locate the "color" folder
-def find_color_folder(base_path):
-    for root, dirs, files in os.walk(base_path):
-        if "color" in dirs:
-            return os.path.join(root, "color")
-    return None
+def main():
+    args = parser.parse_args()
 
-DATASET_PATH = find_color_folder(BASE_PATH)
+    # Dataset source: a local ZIP or directory given with --data, else the kagglehub download
+    if args.data is None:
+        logging.info("Downloading PlantVillage dataset using kagglehub...")
+        try:
+            import kagglehub  # only needed for the download
+            BASE_PATH = kagglehub.dataset_download("abdallahalidev/plantvillage-dataset")
+            logging.info(f"Dataset downloaded to: {BASE_PATH}")
+        except Exception as e:
+            logging.error(f"Failed to download dataset: {e}")
+            sys.exit(1)
+    else:
+        BASE_PATH = args.data
 
-if DATASET_PATH is None:
-    logging.error("Could not find 'color' folder inside dataset.")
-    sys.exit(1)
+    try:
+        source = open_source(BASE_PATH, args.subdir)
+    except FileNotFoundError:
+        logging.error(f"Could not find '{args.subdir}' folder inside dataset.")
+        sys.exit(1)
 
-logging.info(f"Using dataset directory: {DATASET_PATH}")
+    if isinstance(source, DirectorySource):
+        logging.info(f"Using dataset directory: {source.root}")
+    else:
+        logging.info(f"Using dataset archive: {source.path}")
 
 
-# Feature extraction
-def extract_features(image):
-    try:
-        img = cv2.resize(image, (64, 64))  # resize
-        hist = cv2.calcHist([img], [0, 1, 2], None,
-                            [8, 8, 8], [0, 256, 0, 256, 0, 256])
-        return cv2.normalize(hist, hist).flatten()
-    except Exception as e:
-        logging.warning(f"Error extracting features: {e}")
-        return None
-
-
-# Load dataset
-logging.info(f"Loading dataset from {DATASET_PATH}...")
-X, y = [], []
-for label_dir in Path(DATASET_PATH).iterdir():
-    if label_dir.is_dir():
-        label = label_dir.name
-        logging.info(f"Processing directory: {label}")
-        for img_path in label_dir.glob("*.jpg"):
-            img = cv2.imread(str(img_path))
-            if img is None:
-                logging.warning(f"Failed to load image: {img_path}")
-                continue
-            features = extract_features(img)
-            if features is not None:
-                X.append(features)
-                y.append(label)
-
-# Convert to numpy arrays
-X = np.array(X)
-y = np.array(y)
-
-if len(X) == 0 or len(y) == 0:
-    logging.error("No valid data extracted. Check dataset structure.")
-    sys.exit(1)
-
-logging.info(f"Extracted features for {len(X)} images with {X.shape[1]} features each.")
-
-
-# Encode + scale
-le = LabelEncoder()
-y = le.fit_transform(y)
-scaler = StandardScaler()
-X = scaler.fit_transform(X)
-
-# Save encoder and scaler
-joblib.dump(le, "label_encoder.pkl")
-joblib.dump(scaler, "scaler.pkl")
-
-# Train/val/test split
-X_train, X_temp, y_train, y_temp = train_test_split(X, y, test_size=0.3, random_state=42)
-X_val, X_test, y_val, y_test = train_test_split(X_temp, y_temp, test_size=0.5, random_state=42)
-
-logging.info(f"Dataset sizes: Train={len(X_train)}, Val={len(X_val)}, Test={len(X_test)}")
-
-
-# Model training
-best_k, best_acc = 5, 0
-for k in [3, 5, 7, 9]:
-    model = KNeighborsClassifier(n_neighbors=k, metric='euclidean')
-    model.fit(X_train, y_train)
-    y_val_pred = model.predict(X_val)
-    acc = accuracy_score(y_val, y_val_pred)
-    logging.info(f"K={k}, Validation Accuracy={acc:.2f}")
-    if acc > best_acc:
-        best_acc, best_k = acc, k
-
-logging.info(f"Best K: {best_k} with Validation Accuracy: {best_acc:.2f}")
-
-# Retrain with best K
-knn = KNeighborsClassifier(n_neighbors=best_k, metric='euclidean')
-knn.fit(X_train, y_train)
-
-# Save final model
-joblib.dump(knn, "knn_model.pkl")
-logging.info("Final model saved as knn_model.pkl")
-
-
-# Evaluation
-y_pred = knn.predict(X_test)
-test_acc = accuracy_score(y_test, y_pred)
-logging.info(f"Test Accuracy: {test_acc:.2f}")
-
-print("\nClassification Report:")
-print(classification_report(y_test, y_pred, target_names=le.classes_))
+    # Load dataset: features for every image, via the on-disk feature cache. ZIP members
+    # are decoded straight from the archive, without extracting it.
+    items = source.items()
+    logging.info(f"Loading {len(items)} images from {BASE_PATH}...")
+    le = LabelEncoder()
+    cache = update_cache(items, cache_dir=args.cache_dir, workers=args.workers, feature_set=args.features,
+                         source=source)
+    keys = readable_keys(cache, items)  # image key of each feature row, kept through the splits
+    if args.out_of_core:
+        # Out-of-core: two passes over the cached features, one chunk in memory at a time.
+        # The scaler is fitted with partial_fit, then the scaled rows are written into a
+        # memmapped matrix ordered train | val | test, so each split is a view of the file.
+        unbounded = [f"--{name} {value}" for name, value in
+                     (("reduce", args.reduce), ("condense", args.condense), ("cascade", args.cascade)) if value != "none"]
+        if unbounded:
+            logging.warning(f"{', '.join(unbounded)}: not memory-bounded, the whole training matrix is "
+                            f"loaded into memory for these steps")
+        scaler, labels, dim = fit_scaler(iter_chunks(cache, items, args.chunk_size))
+        if len(labels) == 0:
+            logging.error("No valid data extracted. Check dataset structure.")
+            sys.exit(1)
+        logging.info(f"Extracted {args.features} features for {len(labels)} images with {dim} features each.")
+
+        y = le.fit_transform(labels)
+        order, n_train, n_val = split_order(len(y))
+        position = np.empty(len(y), dtype=np.int64)
+        position[order] = np.arange(len(y))
+        X = write_scaled(iter_chunks(cache, items, args.chunk_size), scaler, args.memmap_path, len(y), dim, position)
+        y, keys = y[order], keys[order]
+        keys_train = keys[:n_train]
+        X_train, X_val, X_test = X[:n_train], X[n_train:n_train + n_val], X[n_train + n_val:]
+        y_train, y_val, y_test = y[:n_train], y[n_train:n_train + n_val], y[n_train + n_val:]
+    else:
+        X, y = load_dataset(cache, items)
+
+        if len(X) == 0 or len(y) == 0:
+            logging.error("No valid data extracted. Check dataset structure.")
+            sys.exit(1)
+
+        logging.info(f"Extracted {args.features} features for {len(X)} images with {X.shape[1]} features each.")
+
+        # Encode + scale
+        y = le.fit_transform(y)
+        scaler = StandardScaler()
+        X = scaler.fit_transform(X)
+
+        # Train/val/test split
+        X_train, X_temp, y_train, y_temp, keys_train, keys_temp = train_test_split(
+            X, y, keys, test_size=0.3, random_state=42)
+        X_val, X_test, y_val, y_test = train_test_split(X_temp, y_temp, test_size=0.5, random_state=42)
+
+    # Save encoder and scaler
+    scaler.feature_set_ = args.features  # read back by the serving code
+    joblib.dump(le, "label_encoder.pkl")
+    joblib.dump(scaler, "scaler.pkl")
+
+    logging.info(f"Dataset sizes: Train={len(X_train)}, Val={len(X_val)}, Test={len(X_test)}")
+
+
+    # Model selection: the validation neighbors are searched once per metric at the largest k,
+    # and every (metric, weights, k) in the grid is scored from that cached graph
+    selection = sweep(X_train, y_train, X_val, y_val, ks=args.k, weightings=args.weights,
+                      metrics=args.metrics, n_jobs=args.sweep_jobs)
+    for result in selection["results"][:10]:
+        logging.info(f"K={result['k']}, metric={result['metric']}, weights={result['weights']}, "
+                     f"Validation Accuracy={result['accuracy']:.4f}")
+    with open("knn_sweep_report.json", "w") as f:
+        json.dump(selection, f, indent=2)
+    logging.info(f"{selection['configurations']} configurations scored in "
+                 f"{sum(selection['graph_seconds'].values()) + selection['score_seconds']:.2f}s; "
+                 f"report saved as knn_sweep_report.json")
+
+    best = selection["best"]
+    best_k, best_acc = best["k"], best["accuracy"]
+    knn_params = {"metric": best["metric"], "weights": best["weights"]}
+    logging.info(f"Best K: {best_k} ({best['metric']}, {best['weights']}) with Validation Accuracy: {best_acc:.4f}")
+
+    # Final model with the selected configuration. Out of core, no KNeighborsClassifier is
+    # pickled (it would be a second full copy of the training matrix): a float32 exact
+    # index stands in for it (searching the memmap itself for the euclidean metric), and
+    # only knn_store/ is served.
+    if args.out_of_core:
+        knn = ExactIndex(n_neighbors=best_k, **knn_params).fit(X_train, y_train)
+        if os.path.exists("knn_model.pkl"):
+            os.remove("knn_model.pkl")  # from an earlier run, no longer matching scaler.pkl
+        logging.info("Out-of-core: knn_model.pkl not saved, serve from knn_store/")
+    else:
+        knn = KNeighborsClassifier(n_neighbors=best_k, **knn_params)
+        knn.fit(X_train, y_train)
+
+        # Save final model
+        joblib.dump(knn, "knn_model.pkl")
+        logging.info("Final model saved as knn_model.pkl")
+
+
+    # Optional reduction stage for the serving index; unless --components is given, the
+    # smallest dimensionality within --max-accuracy-drop on the validation split wins
+    projection, reduction_sweep = None, None
+    X_index, X_index_val, X_index_test = X_train, X_val, X_test
+    if args.reduce != "none":
+        n_components = args.components
+        if n_components is None:
+            reduction_sweep = sweep_components(args.reduce, X_train, y_train, X_val, y_val, best_k, dtype=args.dtype, **knn_params)
+            for result in reduction_sweep:
+                logging.info(f"{args.reduce} dims={result['n_components']}: accuracy={result['accuracy']:.4f}, "
+                             f"{result['latency_ms_per_query']:.3f} ms/query, {result['megabytes']:.1f} MB")
+            n_components = choose_components(reduction_sweep, args.max_accuracy_drop)
+        if n_components is None:
+            logging.info(f"No {args.reduce} dimensionality within {args.max_accuracy_drop} accuracy; not reducing")
+        else:
+            W, center = fit_reduction(args.reduce, X_train, n_components)
+            X_index, X_index_val, X_index_test = (project(X, W, center) for X in (X_train, X_val, X_test))
+            matrix, offset = fuse(scaler.mean_, scaler.scale_, W, center)
+            projection = {"kind": args.reduce, "n_components": n_components, "matrix": matrix, "offset": offset}
+            logging.info(f"Reducing {X_train.shape[1]} -> {n_components} dims with {args.reduce}")
+
+    # Optional condensation of the reference set; the smallest level within
+    # --condense-tolerance of the full set's validation accuracy is served
+    X_ref, y_ref, ref_ids, index_k, condensation = X_index, y_train, None, best_k, None
+    if args.condense != "none":
+        methods = CONDENSE_METHODS if args.condense == "all" else [args.condense]
+        levels, reference_sets = sweep_condensation(methods, X_index, y_train, X_index_val, y_val, best_k,
+                                                    levels=args.condense_levels, dtype=args.dtype, **knn_params)
+        chosen = choose_reference(levels, args.condense_tolerance)
+        X_ref, y_ref, ref_ids = reference_sets[chosen["level"]]
+        index_k = chosen["k"]
+        condensation = {"method": args.condense, "tolerance": args.condense_tolerance,
+                        "chosen": chosen["level"], "levels": levels}
+        logging.info(f"Serving reference set {chosen['level']}: {len(X_ref)} of {len(X_index)} rows, k={index_k}")
+
+    # Build the serving neighbor index and save it as a memory-mappable model store
+    index_params = {"n_lists": args.n_lists, "n_probe": args.n_probe} if args.index == "ivf" else {}
+    index = build_index(args.index, X_ref, y_ref, n_neighbors=index_k, dtype=args.dtype,
+                        **knn_params, **index_params)
+    # Neighbors are returned as the training row and image key they came from; ref_ids maps
+    # the rows of a condensed set back to the training rows
+    save_index(index, "knn_store", scaler, le.classes_, feature_set=args.features, projection=projection,
+               train_keys=keys_train, reference_ids=ref_ids)
+    logging.info(f"{args.index} neighbor index ({args.dtype}) saved to knn_store/")
+
+    # Recall-vs-latency report on the held-out split
+    exact = ExactIndex(n_neighbors=index_k, **knn_params).fit(X_ref, y_ref)
+    report = {"index": args.index, "features": args.features, "k": index_k, **knn_params,
+              "train_size": len(X_train), "reference_size": len(X_ref), "test_size": len(X_test)}
+    report["reduction"] = {"kind": args.reduce, "dims": X_index.shape[1], "sweep": reduction_sweep}
+    report["condensation"] = condensation
+    report["exact"] = evaluate_index(exact, exact, X_index_test, y_test)
+
+    # Accuracy delta of each storage type versus the final model (which searches the full,
+    # unreduced training set, so the delta includes any reduction or condensation loss):
+    # the float64 KNeighborsClassifier, or out of core the float32 exact index on the memmap
+    report["storage"] = {"baseline": {"model": type(knn).__name__, "dtype": str(X_train.dtype),
+                                      "accuracy": float(accuracy_score(y_test, knn.predict(X_test))),
+                                      "megabytes": X_train.nbytes / 2**20}}
+    for dtype in ["float32", "float16", "int8"]:
+        stored = exact if dtype == "float32" else ExactIndex(n_neighbors=index_k, dtype=dtype, **knn_params).fit(X_ref, y_ref)
+        acc = float(np.mean(stored.predict(X_index_test) == y_test))
+        report["storage"][dtype] = {"accuracy": acc, "megabytes": stored.nbytes / 2**20}
+    for dtype, result in report["storage"].items():
+        result["accuracy_delta"] = result["accuracy"] - report["storage"]["baseline"]["accuracy"]
+        logging.info(f"{dtype} storage: accuracy={result['accuracy']:.4f} "
+                     f"(delta {result['accuracy_delta']:+.4f}), {result['megabytes']:.1f} MB")
+    if args.index == "ivf":
+        report["n_lists"] = len(index.centroids_)
+        report["ivf"] = []
+        for n_probe in sorted({1, 2, 4, 8, 16, 32, args.n_probe}):
+            index.n_probe = n_probe
+            result = evaluate_index(index, exact, X_index_test, y_test)
+            result["n_probe"] = n_probe
+            report["ivf"].append(result)
+            logging.info(f"n_probe={n_probe}: recall@{index_k}={result['recall_at_k']:.3f}, "
+                         f"accuracy={result['accuracy']:.3f}, {result['latency_ms_per_query']:.3f} ms/query")
+        index.n_probe = args.n_probe
+    with open("knn_index_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info("Recall-vs-latency report saved as knn_index_report.json")
+
+
+    # Optional early-exit cascade: cheap models trained on the served features answer the
+    # images they are confident about, the rest fall through to the neighbor index
+    cascade_path = os.path.join("knn_store", "cascade.pkl")
+    if args.cascade == "none":
+        if os.path.exists(cascade_path):
+            os.remove(cascade_path)
+    else:
+        names = args.cascade.split("+")
+        n_classes = len(le.classes_)
+        stage_models = fit_stages(names, X_index, y_train)
+        final_val = index.predict(X_index_val) == y_val
+        cascade = calibrate(stage_models, names, X_index_val, y_val, final_val, n_classes, args.cascade_tolerance)
+        joblib.dump(cascade, cascade_path)
+        logging.info(f"Cascade {' -> '.join(cascade.names + ['knn'])} saved to {cascade_path} "
+                     f"(thresholds {[round(s['threshold'], 3) for s in cascade.stages]})")
+
+        # Latency-vs-accuracy of the neighbor index alone and of the cascades on the test split
+        cascade_report = benchmark_cascade(stage_models, names, index, X_index_val, y_val,
+                                           X_index_test, y_test, n_classes)
+        cascade_report["served"] = {"stages": cascade.names, "tolerance": args.cascade_tolerance,
+                                    "thresholds": {s["name"]: s["threshold"] for s in cascade.stages}}
+        for result in cascade_report["results"]:
+            logging.info(f"{' -> '.join(result['stages'] + ['knn']):20s} tolerance={result['tolerance']}: "
+                         f"accuracy={result['accuracy']:.4f}, {result['latency_ms_per_image']:.3f} ms/image, "
+                         f"exits={ {k: round(v, 3) for k, v in result['exit_rates'].items()} }")
+        with open("knn_cascade_report.json", "w") as f:
+            json.dump(cascade_report, f, indent=2)
+        logging.info("Cascade latency-vs-accuracy report saved as knn_cascade_report.json")
+
+
+    # Evaluation
+    y_pred = knn.predict(X_test)
+    test_acc = accuracy_score(y_test, y_pred)
+    logging.info(f"Test Accuracy: {test_acc:.2f}")
+
+    print("\nClassification Report:")
+    print(classification_report(y_test, y_pred, target_names=le.classes_))
+
 
+if __name__ == "__main__":
+    main()
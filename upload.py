@@ -0,0 +1,77 @@
+import os
+import io
+from PIL import Image
+
+# Limits for a single uploaded image
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 40_000_000))
+
+# The first read must contain the magic bytes; dimensions are parsed from it when the header fits
+HEADER_BYTES = 64 * 1024
+CHUNK_BYTES = 256 * 1024
+
+# Leading bytes of the image formats we accept
+MAGIC_BYTES = [
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+]
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+# Image format from the magic bytes, or None
+def sniff_format(head):
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    for magic, fmt in MAGIC_BYTES:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+# (width, height) from the header alone; PIL only parses the header on open().
+# None when the header doesn't fit in the bytes read so far.
+def header_size(head):
+    try:
+        with Image.open(io.BytesIO(head)) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+# Read an UploadFile in chunks, rejecting it as soon as it is known to be bad:
+# declared or running size over the limit, unknown magic bytes, or too many pixels
+async def read_upload(file, max_bytes=MAX_UPLOAD_BYTES, max_pixels=MAX_IMAGE_PIXELS):
+    if file.size is not None and file.size > max_bytes:
+        raise UploadRejected(413, f"File too large; limit is {max_bytes} bytes")
+
+    head = await file.read(HEADER_BYTES)
+    if not head:
+        raise UploadRejected(400, "Empty file")
+    if sniff_format(head) is None:
+        raise UploadRejected(415, "Unsupported or invalid image data")
+    size = header_size(head)
+    if size is not None and size[0] * size[1] > max_pixels:
+        raise UploadRejected(413, f"Image too large: {size[0]}x{size[1]} pixels; limit is {max_pixels}")
+
+    chunks = [head]
+    total = len(head)
+    while True:
+        chunk = await file.read(CHUNK_BYTES)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise UploadRejected(413, f"File too large; limit is {max_bytes} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
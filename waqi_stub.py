@@ -0,0 +1,48 @@
+import os
+import random
+from datetime import datetime
+from fastapi import FastAPI, Response
+import uvicorn
+
+# Local stand-in for the WAQI feed API, for exercising aqi_fetcher.py without a token:
+#   uvicorn waqi_stub:app --port 8500
+#   python aqi_fetcher.py --base-url http://127.0.0.1:8500
+# STUB_FAILURE_RATE makes that share of requests answer 503 to exercise the retries.
+FAILURE_RATE = float(os.environ.get("STUB_FAILURE_RATE", 0))
+
+app = FastAPI(title="WAQI stub")
+requests_seen = {"total": 0, "failed": 0}
+
+
+@app.get("/feed/{city}/")
+def feed(city: str, response: Response, token: str = ""):
+    requests_seen["total"] += 1
+    if random.random() < FAILURE_RATE:
+        requests_seen["failed"] += 1
+        response.status_code = 503
+        return {"status": "error", "data": "temporarily unavailable"}
+    if city.lower() == "unknown":
+        return {"status": "error", "data": "Unknown station"}
+    pm25 = random.randint(10, 300)
+    return {
+        "status": "ok",
+        "data": {
+            "aqi": pm25 + random.randint(0, 40),
+            "time": {"s": datetime.now().strftime("%Y-%m-%d %H:00:00")},
+            "iaqi": {
+                "pm25": {"v": pm25},
+                "t": {"v": round(random.uniform(-5, 40), 1)},
+                "h": {"v": random.randint(10, 95)},
+                "w": {"v": round(random.uniform(0, 15), 1)},
+            },
+        },
+    }
+
+
+@app.get("/stats")
+def stats():
+    return requests_seen
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=8500)